@@ -0,0 +1,126 @@
+import re
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from flask import Response, request
+
+from app import server
+from app_df import get_storm_data, get_list_years, get_wildfire_weather_summary
+from notebooks.data_constants import STORM_CATEGORIES
+
+# Read-only JSON api over the storm aggregates used by the dashboards.
+# Responses are column oriented: {"columns": [...], "data": {column: [values]}, "page": ...}
+# and carry an ETag and Cache-Control header; a request with a matching If-None-Match gets a 304.
+API_PREFIX = '/api/v1'
+PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+MAX_AGE = 3600 # seconds
+
+EVENT_COLUMNS = ['NAME', 'FIPS', 'STATE', 'EVENT_TYPE', 'EVENT_DATE', 'TOTAL_DAMAGE', 'TORNADO_STRENGTH']
+
+class ApiError(Exception):
+    pass
+
+@server.errorhandler(ApiError)
+def handle_api_error(err):
+    return Response(json.dumps({'error': str(err)}), status=400, mimetype='application/json')
+
+def json_response(payload):
+    body = json.dumps(payload, separators=(',', ':'), allow_nan=False) # compact json
+    resp = Response(body, mimetype='application/json')
+    resp.set_etag(hashlib.sha1(body.encode('utf-8')).hexdigest())
+    resp.cache_control.public = True
+    resp.cache_control.max_age = MAX_AGE
+    return resp.make_conditional(request)
+
+def to_columns(df):
+    # dict column: list of values; dates as yyyy-mm-dd, NaN as null
+    data = {}
+    for c in df.columns:
+        col = df[c]
+        if pd.api.types.is_datetime64_any_dtype(col):
+            col = col.dt.strftime('%Y-%m-%d')
+        col = col.astype(object).where(col.notna(), None)
+        data[c] = [v.item() if isinstance(v, np.generic) else v for v in col]
+    return {'columns': df.columns.tolist(), 'data': data}
+
+def paginate(df):
+    page = request.args.get('page', 1, type=int)
+    page_size = request.args.get('page_size', PAGE_SIZE, type=int)
+    if page < 1 or page_size < 1 or page_size > MAX_PAGE_SIZE:
+        raise ApiError(f'page must be >= 1 and page_size between 1 and {MAX_PAGE_SIZE}')
+    total = df.shape[0]
+    payload = to_columns(df.iloc[(page-1)*page_size:page*page_size])
+    payload.update({'page': page, 'page_size': page_size, 'total': total,
+                    'pages': (total + page_size - 1)//page_size})
+    return payload
+
+def get_year():
+    year = request.args.get('year', '')
+    if year not in get_list_years():
+        raise ApiError(f'unknown year: {year}')
+    return year
+
+def get_category():
+    category = request.args.get('category', 'all')
+    if category != 'all' and category not in STORM_CATEGORIES:
+        raise ApiError(f"category must be 'all' or one of {list(STORM_CATEGORIES.keys())}")
+    return category
+
+def get_inflation():
+    return request.args.get('inflation', '1') not in ('0', 'false')
+
+@server.route(f'{API_PREFIX}/years')
+def api_years():
+    return json_response({'years': list(get_list_years())})
+
+@server.route(f'{API_PREFIX}/events')
+def api_events():
+    # storm events of a year, optionally of a category and a county (FIPS); the damage of an
+    # event is nominal (only the county totals are adjusted for inflation), so no inflation parameter
+    year = get_year()
+    category = get_category()
+    _, df_counties, _ = get_storm_data(year, True)
+    if category != 'all':
+        df_counties = df_counties[df_counties[category]==True]
+    fips = request.args.get('fips')
+    if fips is not None:
+        df_counties = df_counties[df_counties['FIPS'] == fips.zfill(5)]
+    return json_response(paginate(df_counties[EVENT_COLUMNS]))
+
+@server.route(f'{API_PREFIX}/counties/damage')
+def api_county_damage():
+    # total damage of every county in a year, for all events or a category
+    year = get_year()
+    category = get_category()
+    df_map, _, _ = get_storm_data(year, get_inflation())
+    if category == 'all':
+        df_map = df_map[['FIPS', 'NAME', 'TOTAL_DAMAGE']]
+    else:
+        i = list(STORM_CATEGORIES.keys()).index(category)
+        df_map = df_map[df_map[category]==True][['FIPS', 'NAME', 'TYPE_'+str(i)+'_DAMAGE']]
+        df_map = df_map.rename(columns={'TYPE_'+str(i)+'_DAMAGE': 'TOTAL_DAMAGE'})
+    df_map = df_map.sort_values('TOTAL_DAMAGE', ascending=False)
+    return json_response(paginate(df_map))
+
+@server.route(f'{API_PREFIX}/wildfires')
+def api_wildfires():
+    # wildfire events of a year; EVENT_ID is used to get the weather of the event
+    year = get_year()
+    _, df_counties, _ = get_storm_data(year, True)
+    df_counties = df_counties[df_counties['EVENT_TYPE'] == 'Wildfire']
+    df = df_counties[['NAME', 'FIPS', 'EVENT_DATE', 'TOTAL_DAMAGE']].copy()
+    df.insert(0, 'EVENT_ID', df_counties['EVENT_DATE'].dt.strftime('%m_%d') + '_' + df_counties['FIPS'])
+    df = df.drop_duplicates(subset=['EVENT_ID'])
+    return json_response(paginate(df))
+
+@server.route(f'{API_PREFIX}/wildfires/<year>/<event_id>/weather')
+def api_wildfire_weather(year, event_id):
+    # yearly precipitation and temperature for the 10 years before a wildfire event
+    if not re.fullmatch(r'\d{4}', year) or not re.fullmatch(r'\d{2}_\d{2}_\d{5}', event_id):
+        raise ApiError('the wildfire event is <year>/<mm_dd>_<FIPS>')
+    df = get_wildfire_weather_summary(year, event_id)
+    if df is None:
+        raise ApiError(f'no weather data for wildfire {year}/{event_id}')
+    return json_response(to_columns(df))
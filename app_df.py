@@ -1,4 +1,9 @@
 import re
+import os
+import time
+import shutil
+import hashlib
+import threading
 import pandas as pd
 import numpy as np
 import json
@@ -8,12 +13,23 @@ import psycopg2
 from app import cache, cache_found
 from notebooks.amazon_cred import ENDPOINT, PORT, USER, PASSWORD, DATABASE
 from notebooks.data_constants import NOAA_CSVFILES_URL, GEOJSON_COUNTIES_URL, BLS_CPI_CSV
-from notebooks.data_constants import STORM_CATEGORIES
+from notebooks.data_constants import STORM_CATEGORIES, BEGIN_YEAR
 
 # Redis Constants
 CACHE_DATAFRAME = 0
 CACHE_FIGURE = 1
 
+# County reference (one row per county FIPS)
+COUNTY_REF_CSV = 'data/county_ref.csv'
+WILDFIRE_DATA_DIR = 'data/wildfires/'
+
+# Damage cube: county (FIPS) x year x category, saved as .npy files (in a directory per data key)
+# that are memory mapped
+DAMAGE_CUBE_DIR = 'data/damage_cube'
+CUBE_CATEGORIES = ['all'] + list(STORM_CATEGORIES.keys()) # same values as the layers dropdown
+CUBE_NOMINAL = 0
+CUBE_INFLATION = 1
+
 # A decorator takes in a function and returns a new function from it.
 # So, if you want a conditional decorator, all you need is to return
 # the initial function when you do not want the decorator to be applied.
@@ -23,6 +39,19 @@ def cache_memoize_conditional(fn):
     else:
         return fn
 
+# Same as cache_memoize_conditional for a function without arguments that is called on every
+# request: without redis, its value is kept in the process for the default timeout of the cache
+def cache_memoize_timed(fn):
+    if cache_found:
+        return cache.memoize()(fn)
+    memo = {'value': None, 'expires': 0}
+    def memoized():
+        if memo['expires'] < time.time():
+            memo['value'] = fn()
+            memo['expires'] = time.time() + cache.cache.default_timeout
+        return memo['value']
+    return memoized
+
 @cache_memoize_conditional
 def download_counties_json(url):
     with urlopen(url) as response:
@@ -32,6 +61,22 @@ def download_counties_json(url):
 def get_counties_json():
     return download_counties_json(GEOJSON_COUNTIES_URL)
 
+# FIPS indexed county reference (FIPS_STR, NAME, County, State, POS, LAT, LON); it is static and
+# committed with the app: generated offline by download_county_ref_file in Storm_Database.ipynb
+def get_county_ref():
+    return pd.read_csv(COUNTY_REF_CSV, index_col='FIPS', dtype={'FIPS_STR': str})
+
+def join_county_ref(df, df_ref):
+    # join rows keyed by an integer FIPS column to the county reference by array position;
+    # rows without a county in the reference are dropped (same as an inner merge)
+    pos = df_ref.index.get_indexer(df['FIPS'].values)
+    found = pos >= 0
+    pos = pos[found]
+    df = df[found].copy()
+    df['FIPS'] = df_ref['FIPS_STR'].values[pos]
+    df['NAME'] = df_ref['NAME'].values[pos]
+    return df
+
 @cache_memoize_conditional
 def get_list_csvfiles(url):
     html = pd.read_html(url)
@@ -47,6 +92,56 @@ def get_list_csvfiles(url):
             files_dict[result[0]] = fname
     return files_dict
 
+# version (the _c<date> of the NOAA file) of the data of a year in the database;
+# figures are cached per version so that a refreshed year does not show stale figures.
+# The version is '' when it is not recorded (noaa_versions is created by notebooks.storm_ingest):
+# memoize does not cache None, every call would open a database connection
+@cache_memoize_conditional
+def get_data_version(year):
+    conn = psycopg2.connect(
+        host=ENDPOINT,
+        port=PORT,
+        user=USER,
+        password=PASSWORD,
+        database = DATABASE
+    )
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute('SELECT "VERSION" from noaa_versions WHERE "Year" = %s', (int(year),))
+                row = cur.fetchone()
+    except psycopg2.Error: # no noaa_versions table
+        row = None
+    conn.close()
+    return row[0] if row is not None else ''
+
+# called by notebooks.storm_ingest --refresh after a year is ingested again:
+# drop only the cached entries of that year (the damage cube is keyed by the data, see get_cube_key)
+def invalidate_year(year):
+    if not cache_found:
+        return
+    year = str(year) # the year is a string in the dropdowns
+    for inflation in [True, False]:
+        cache.delete_memoized(get_storm_data, year, inflation)
+    cache.delete_memoized(get_data_version, year)
+    cache.delete_memoized(get_list_csvfiles, NOAA_CSVFILES_URL) # the year may be new
+    cache.delete_memoized(get_cube_key)
+
+# yearly weather statistics of a wildfire event (directory <year>/<mm_dd>_<FIPS>)
+@cache_memoize_conditional
+def get_wildfire_weather_summary(year, event_id):
+    path = os.path.join(WILDFIRE_DATA_DIR, str(year), event_id, 'weather.csv')
+    if not os.path.exists(path):
+        return None
+    df_weather = pd.read_csv(path)
+    df_weather['PRCP'] = df_weather['PRCP'].fillna(0) + df_weather['SNOW'].fillna(0)
+    df_weather['YEAR'] = pd.to_datetime(df_weather['DATE']).dt.year
+    return df_weather.groupby('YEAR', as_index=False).agg(PRCP=('PRCP', 'sum'),
+                                                          TMAX_MEAN=('TMAX', 'mean'),
+                                                          TMIN_MEAN=('TMIN', 'mean'),
+                                                          TMAX_MAX=('TMAX', 'max'),
+                                                          DAYS=('TMAX', 'count'))
+
 def get_list_years():
     files_dict = get_list_csvfiles(NOAA_CSVFILES_URL)
     return files_dict.keys()
@@ -156,3 +251,130 @@ def get_storm_data(year, inflation, cache_id=CACHE_DATAFRAME):
     df_map['EVENT_TYPE_2'] = df_map['EVENT_TYPE_2'].apply(build_event_type)
 
     return df_map, df_counties, df_county_details
+
+
+# key of the data behind the damage cube: the NOAA file versions (noaa_versions), the number of
+# rows and the total damage of the counties table and the months of CPI data. The cube is saved
+# under its key and every process checks the key (memoized, so at most every 5 minutes) before using it
+@cache_memoize_timed
+def get_cube_key():
+    conn = psycopg2.connect(
+        host=ENDPOINT,
+        port=PORT,
+        user=USER,
+        password=PASSWORD,
+        database = DATABASE
+    )
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute('SELECT COUNT(*), SUM("TOTAL_DAMAGE") from counties')
+            counts = cur.fetchone()
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute('SELECT "Year", "VERSION" from noaa_versions ORDER BY "Year"')
+                versions = cur.fetchall()
+    except psycopg2.Error: # no noaa_versions table
+        versions = []
+    conn.close()
+    data = repr((counts, versions, get_bls_cpi().shape[0]))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()[:16]
+
+def get_cube_data():
+    conn = psycopg2.connect(
+        host=ENDPOINT,
+        port=PORT,
+        user=USER,
+        password=PASSWORD,
+        database = DATABASE
+    )
+    with conn:
+        columns = ', '.join(f'"{c}"' for c in ['FIPS', 'EVENT_DATE', 'TOTAL_DAMAGE', 'Year'] + CUBE_CATEGORIES[1:])
+        df = pd.read_sql(f'SELECT {columns} from counties', con=conn)
+    conn.close()
+    return df
+
+# damage and number of events of every county, year and category in dense numpy arrays:
+#   damage[fips, year, category, CUBE_NOMINAL or CUBE_INFLATION], events[fips, year, category]
+# answering "how has damage in this county evolved?" is a slice of the arrays
+def build_damage_cube(key):
+    df = get_cube_data()
+
+    fips, fips_idx = np.unique(np.asarray(df['FIPS'], dtype='U5'), return_inverse=True)
+    years = np.arange(min(BEGIN_YEAR, df['Year'].min()), df['Year'].max() + 1)
+    year_idx = df['Year'].values - years[0]
+    flat_idx = fips_idx * len(years) + year_idx
+
+    # adjust damage to 2020 dollars using the cpi of the month of the event
+    event_date = pd.to_datetime(df['EVENT_DATE'])
+    cpi = get_bls_cpi().set_index(['year', 'period'])['value'].sort_index()
+    cpi_event = np.array(cpi.reindex(pd.MultiIndex.from_arrays([event_date.dt.year, event_date.dt.month])), dtype=float)
+    cpi_2020 = np.array(cpi.reindex(pd.MultiIndex.from_arrays([np.full(len(df), 2020), event_date.dt.month])), dtype=float)
+    missing = np.isnan(cpi_event)
+    if missing.any(): # events after the last month of the cpi data
+        last_year, last_month = cpi.index[-1]
+        print(f'damage cube: no CPI for {missing.sum()} events, adjusted with the CPI of {last_year}-{last_month:02d}')
+        cpi_event[missing] = cpi.iloc[-1]
+    nominal = df['TOTAL_DAMAGE'].values
+    adjusted = nominal * (cpi_2020/cpi_event)
+
+    shape = (len(fips), len(years))
+    damage = np.zeros(shape + (len(CUBE_CATEGORIES), 2))
+    events = np.zeros(shape + (len(CUBE_CATEGORIES),), dtype=np.int32)
+    for i, c in enumerate(CUBE_CATEGORIES):
+        mask = np.ones(len(df), dtype=bool) if c == 'all' else df[c].values.astype(bool)
+        size = shape[0]*shape[1]
+        damage[:, :, i, CUBE_NOMINAL] = np.bincount(flat_idx[mask], nominal[mask], size).reshape(shape)
+        damage[:, :, i, CUBE_INFLATION] = np.bincount(flat_idx[mask], adjusted[mask], size).reshape(shape)
+        events[:, :, i] = np.bincount(flat_idx[mask], minlength=size).reshape(shape)
+
+    # write into a temporary directory and rename it, so that a partial cube is never loaded
+    cube_dir = os.path.join(DAMAGE_CUBE_DIR, key)
+    tmp_dir = f'{cube_dir}.{os.getpid()}'
+    os.makedirs(tmp_dir, exist_ok=True)
+    for name, arr in [('fips', fips), ('years', years), ('damage', damage), ('events', events)]:
+        np.save(os.path.join(tmp_dir, name + '.npy'), arr)
+    try:
+        os.rename(tmp_dir, cube_dir)
+    except OSError: # another process saved the cube first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    # remove the cubes of older data; a process that still has one memory mapped keeps its pages
+    for name in os.listdir(DAMAGE_CUBE_DIR):
+        if name != key and '.' not in name:
+            shutil.rmtree(os.path.join(DAMAGE_CUBE_DIR, name), ignore_errors=True)
+
+damage_cube = None
+cube_builder = None # thread building the cube of new data while the cube of the old data is served
+cube_lock = threading.Lock()
+def get_damage_cube():
+    # loaded once per process for every key, memory mapped: the pages are shared by all the processes
+    global damage_cube, cube_builder
+    key = get_cube_key()
+    if damage_cube is not None and damage_cube['key'] == key:
+        return damage_cube
+    cube_dir = os.path.join(DAMAGE_CUBE_DIR, key)
+    if not os.path.exists(cube_dir):
+        if damage_cube is not None:
+            # the data changed: build the new cube in the background, not in the request
+            with cube_lock:
+                if cube_builder is None or not cube_builder.is_alive():
+                    cube_builder = threading.Thread(target=build_damage_cube, args=(key,), daemon=True)
+                    cube_builder.start()
+            return damage_cube
+        build_damage_cube(key) # first request of the process and no cube saved yet
+    damage_cube = {name: np.load(os.path.join(cube_dir, name + '.npy'), mmap_mode='r')
+                   for name in ['fips', 'years', 'damage', 'events']}
+    damage_cube['key'] = key
+    return damage_cube
+
+def get_county_trend(fips, layers='all', inflation=True):
+    # damage and number of events per year of a county for a layer
+    cube = get_damage_cube()
+    pos = np.searchsorted(cube['fips'], fips)
+    if pos == len(cube['fips']) or cube['fips'][pos] != fips:
+        return None # no events in the county
+    cat = CUBE_CATEGORIES.index(layers)
+    return pd.DataFrame({'YEAR': cube['years'],
+                         'DAMAGE': cube['damage'][pos, :, cat, CUBE_INFLATION if inflation else CUBE_NOMINAL],
+                         'EVENTS': cube['events'][pos, :, cat]})
@@ -7,9 +7,11 @@ from dash.dependencies import Input, Output
 import dash_alternative_viz as dav
 import altair as alt
 
-from app_df import get_counties_json, get_storm_data, get_list_years, CACHE_FIGURE
+from app_df import get_counties_json, get_storm_data, get_list_years, get_data_version, CACHE_FIGURE
+from app_df import get_county_trend
 from notebooks.data_constants import STORM_CATEGORIES
 from app import app, cache
+from blobs import blob_callback
 
 alt.data_transformers.disable_max_rows()
 alt.renderers.enable('default', embed_options={'actions': False}); # hide the option to export chart as png
@@ -50,6 +52,10 @@ layout = html.Div([
 
         html.Div(dcc.Graph(id='graph-us-map', config={'displayModeBar': False}), className='seven columns'),
     ], className='row'),
+    html.Div([
+        html.Div(className='two columns'),
+        html.Div(dcc.Graph(id='graph-county-trend', config={'displayModeBar': False}), className='seven columns'),
+    ], className='row'),
     html.Br(),
     html.P('Click on an event in the graph below to see the statistics for the affected county:'),
     html.Div([
@@ -60,7 +66,7 @@ layout = html.Div([
 ])
 
 @cache.memoize()
-def generate_figure(year, layers='all', inflation=True, cache_id=CACHE_FIGURE):
+def generate_figure(year, layers='all', inflation=True, version=None, cache_id=CACHE_FIGURE):
     title_event = 'storms'
     df_map, _, _ = get_storm_data(year, inflation)
     map_columns = df_map.columns
@@ -116,7 +122,50 @@ def update_graph_us_map(data):
     # get_storm_data has been fetched in the compute_value callback and 
     # the result is stored in the global redis cached
     year, layers , inflation = data
-    return generate_figure(year, layers=layers, inflation=inflation)
+    return generate_figure(year, layers=layers, inflation=inflation, version=get_data_version(year))
+
+# the map and the chart of a (year, layers, inflation) are saved as precompressed blobs per data version;
+# the inputs come from the request, only the values of the controls name a blob
+def signal_blob(prefix, data):
+    if not isinstance(data, list) or len(data) != 3:
+        return None
+    year, layers, inflation = data
+    if not isinstance(year, str) or year not in get_list_years():
+        return None
+    if layers not in [o['value'] for o in option_categories] or not isinstance(inflation, bool):
+        return None
+    version = get_data_version(year)
+    return f'{prefix}/{year}/{layers}/{inflation}/{version}', version
+
+blob_callback('graph-us-map.figure', lambda data: signal_blob('us-map', data))
+blob_callback('vega.spec', lambda data: signal_blob('vega', data))
+
+@app.callback(Output('graph-county-trend', 'figure'),
+              Input('graph-us-map', 'clickData'),
+              Input('signal', 'data'))
+def update_graph_county_trend(clickData, data):
+    # damage in the county clicked on the map for all the years: a slice of the damage cube
+    _, layers, inflation = data
+    if clickData is None:
+        fig = px.bar(pd.DataFrame({'YEAR': [], 'DAMAGE': []}), x='YEAR', y='DAMAGE')
+        fig.update_layout(title_text='<b>Click on a county in the map to see its damage over the years</b>',
+                          title_font_size=13, title_x=0.5, title_xanchor='center')
+        return fig
+
+    point = clickData['points'][0]
+    fips = point['location']
+    name = point.get('hovertext', fips)
+    title_event = 'storms' if layers == 'all' else layers
+
+    df_trend = get_county_trend(fips, layers, inflation)
+    if df_trend is None:
+        df_trend = pd.DataFrame({'YEAR': [], 'DAMAGE': [], 'EVENTS': []})
+    fig = px.bar(df_trend, x='YEAR', y='DAMAGE',
+                 hover_data={'YEAR': True, 'DAMAGE': ':,.0f', 'EVENTS': True},
+                 labels={'DAMAGE': 'Total damage $', 'YEAR': 'Year', 'EVENTS': '# events'})
+    fig.update_layout(title_text=f'<b>Total damage in $ from {title_event} in {name} by year</b>',
+                      title_font_size=13, title_x=0.5, title_xanchor='center')
+    return fig
 
 months = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 
              'August', 'September', 'October', 'November', 'December']
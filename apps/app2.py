@@ -10,15 +10,17 @@ from urllib.error import HTTPError
 import dash_alternative_viz as dav
 import altair as alt
 
-from app_df import get_counties_json, get_list_years, get_storm_data, CACHE_FIGURE
+from app_df import get_counties_json, get_list_years, get_storm_data, get_data_version, CACHE_FIGURE
+from app_df import get_county_ref, join_county_ref
 from app import app, cache
+from blobs import blob_callback
 
 alt.data_transformers.disable_max_rows()
 alt.renderers.enable('default', embed_options={'actions': False}); # hide the option to export chart as png
 
 # Constants
 WILDFIRE_DATA_URL = 'https://raw.githubusercontent.com/ss-github-code/noaa_storm_analysis/main/data/wildfires/'
-df_zone_county = pd.read_csv('data/zone_county_corr.csv')
+df_county_ref = get_county_ref() # FIPS indexed county names, 5 character FIPS and LAT, LON
 
 severity_categories = [{'label': 'Abnormally dry', 'value': 'D0'}, 
                        {'label': 'Moderate', 'value': 'D1'},
@@ -85,7 +87,7 @@ def update_events(year):
     return lst_options, toret, year
 
 @cache.memoize()
-def generate_figure2(year, severity, index, df_counties, cache_id=CACHE_FIGURE):
+def generate_figure2(year, severity, index, df_counties, version=None, cache_id=CACHE_FIGURE):
     
     dirname = WILDFIRE_DATA_URL + str(year) + '/'
         
@@ -96,22 +98,14 @@ def generate_figure2(year, severity, index, df_counties, cache_id=CACHE_FIGURE):
         
     df_usdm = pd.read_csv(dirname+'/usdm.csv')
        
-    df_usdm_merged = df_usdm.merge(df_zone_county, on=['FIPS'])
-    df_usdm_merged['NAME'] = df_usdm_merged['County'] + ', ' + df_usdm_merged['State']
-
-    wildfire_county_df = df_usdm_merged[df_usdm_merged['FIPS'] == int(df_counties.iloc[index]['FIPS'])]
-    # print(wildfire_county_df.shape, df_counties.iloc[wildfiresDrop.index]['FIPS'])
-    df_usdm_merged['FIPS'] = df_usdm_merged['FIPS'].astype(str) # cast it as string in order to zfill
-    df_usdm_merged['FIPS'] = df_usdm_merged['FIPS'].apply(lambda x: x.zfill(5)) # no need to zfill
-
-        
-    county_idx = wildfire_county_df.iloc[0].name
+    df_usdm_merged = join_county_ref(df_usdm, df_county_ref)
+    county_fips = df_counties.iloc[index]['FIPS'] # already a 5 character string
 
     #data = df_usdm_merged[['LAT', 'LON']].values.tolist()
     counties = get_counties_json()
         
     fig = px.scatter_geo(geojson = counties, 
-                            locations=[df_usdm_merged.iloc[county_idx]['FIPS']],
+                            locations=[county_fips],
                             hover_name=[df_counties.iloc[index]['NAME']],
                             color_discrete_sequence=['green'],
                             size=[50],
@@ -143,7 +137,25 @@ def update_graph_usdm_map(event, severity, data):
     # the result is stored in the global redis cached
     year = data
     _, df_counties,_ = get_storm_data(year, True)
-    return generate_figure2(year, severity, event, df_counties)
+    return generate_figure2(year, severity, event, df_counties, version=get_data_version(year))
+
+# the map and the chart of a wildfire event are saved as precompressed blobs per data version;
+# the inputs come from the request, only the values of the controls name a blob
+def event_blob(prefix, event, year):
+    if not isinstance(event, int) or isinstance(event, bool): # index of the event in the year
+        return None
+    if not isinstance(year, str) or year not in get_list_years():
+        return None
+    version = get_data_version(year)
+    return f'{prefix}/{year}/{event}/{version}', version
+
+def usdm_map_blob(event, severity, data):
+    if severity not in [s['value'] for s in severity_categories]:
+        return None
+    return event_blob(f'usdm-map/{severity}', event, data)
+
+blob_callback('graph-usdm-map.figure', usdm_map_blob)
+blob_callback('vega2.spec', lambda event, data: event_blob('vega2', event, data))
 
 @app.callback(Output('vega2', 'spec'), 
               Input('event', 'value'),
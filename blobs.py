@@ -0,0 +1,113 @@
+import os
+import gzip
+import time
+import hashlib
+from flask import Response, request, g
+
+from app import app, server, cache, cache_found
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# The responses of the Dash callbacks that only depend on their inputs and the version of the
+# data (the map figures and the Vega-Lite specs) are saved once, compressed (gzip and brotli),
+# under the hash of their content. A later request for the same inputs is answered with the
+# precompressed blob, without running the callback or serializing and compressing its output again.
+BLOB_DIR = 'data/blobs'
+DASH_UPDATE_URL = app.config.routes_pathname_prefix + '_dash-update-component'
+
+blob_callbacks = {} # output ('graph-us-map.figure'): function(*input values) -> (name, version)
+blob_index = {} # used when redis is not available; name: (key, expires)
+
+def blob_callback(output, name):
+    # name(*inputs) returns the name of the output for the input values and the version of its data,
+    # or None when the output should not be saved
+    blob_callbacks[output] = name
+
+def blob_path(key, encoding):
+    return os.path.join(BLOB_DIR, f'{key}.json.{encoding}')
+
+def write_file(path, data):
+    tmp_path = f'{path}.{os.getpid()}'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def put_blob(body):
+    # body is the json of a callback response; returns the key of the blob
+    key = hashlib.sha1(body).hexdigest()
+    os.makedirs(BLOB_DIR, exist_ok=True)
+    if not os.path.exists(blob_path(key, 'gz')):
+        write_file(blob_path(key, 'gz'), gzip.compress(body, compresslevel=9))
+        if brotli is not None:
+            write_file(blob_path(key, 'br'), brotli.compress(body))
+    return key
+
+def get_blob_key(name):
+    # None when the blob is unknown or is not on this instance's disk
+    if cache_found:
+        key = cache.get('blob:' + name)
+    else:
+        key, expires = blob_index.get(name, (None, None))
+        if expires is not None and expires < time.time():
+            key = None
+    if key is None or not os.path.exists(blob_path(key, 'gz')):
+        return None
+    return key
+
+def set_blob_key(name, key, version):
+    # a name with a data version never changes; without a version (noaa_versions is not there)
+    # it expires like the rest of the cached data
+    timeout = 0 if version else cache.cache.default_timeout
+    if cache_found:
+        cache.set('blob:' + name, key, timeout=timeout)
+    else:
+        blob_index[name] = (key, time.time() + timeout if timeout else None)
+
+def blob_response(key):
+    accept_encoding = request.headers.get('Accept-Encoding', '')
+    if 'br' in accept_encoding and os.path.exists(blob_path(key, 'br')):
+        encoding = 'br'
+    elif 'gzip' in accept_encoding:
+        encoding = 'gzip'
+    else:
+        encoding = None
+    with open(blob_path(key, 'br' if encoding == 'br' else 'gz'), 'rb') as f:
+        data = f.read()
+    if encoding is None:
+        data = gzip.decompress(data)
+
+    resp = Response(data, mimetype='application/json')
+    if encoding is not None:
+        resp.headers['Content-Encoding'] = encoding
+    resp.headers['Vary'] = 'Accept-Encoding'
+    return resp
+
+@server.before_request
+def serve_callback_blob():
+    if request.path != DASH_UPDATE_URL:
+        return None
+    body = request.get_json(silent=True) or {}
+    name = blob_callbacks.get(body.get('output'))
+    if name is None:
+        return None
+    name = name(*[i.get('value') for i in body.get('inputs', [])])
+    if name is None:
+        return None
+    key = get_blob_key(name[0])
+    if key is None:
+        g.blob_name = name # run the callback, save_callback_blob saves its response
+        return None
+    return blob_response(key)
+
+@server.after_request
+def save_callback_blob(response):
+    # runs before the gzip of flask_compress (after_request functions run in reverse order)
+    name = g.pop('blob_name', None)
+    if name is None or response.status_code != 200: # 204 when the callback prevented the update
+        return response
+    key = put_blob(response.get_data())
+    set_blob_key(name[0], key, name[1])
+    return blob_response(key)
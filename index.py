@@ -4,6 +4,7 @@ from dash.dependencies import Input, Output
 
 from app import app, server
 from apps import app1, app2
+import api # read-only json api routes on app.server
 
 app.layout = html.Div([
     dcc.Location(id='url', refresh=False),
@@ -16,3 +16,6 @@ STORM_CATEGORIES = {
     'Severe Local Storms': ['Tornado', 'Hail', 'Thunderstorm', 'Wind'],
     'Wildfires/Droughts': ['Wildfire', 'Drought']
 }
+
+GHCND_STATIONS_URL = 'https://www.ncei.noaa.gov/pub/data/ghcn/daily/ghcnd-stations.txt'
+GHCND_INVENTORY_URL = 'https://www.ncei.noaa.gov/pub/data/ghcn/daily/ghcnd-inventory.txt'
@@ -0,0 +1,434 @@
+'''
+Build the counties table: NOAA storm events joined with the census statistics of every
+affected county, one year at a time.
+
+    python -m notebooks.storm_ingest --years 2000 2022
+
+- census requests for a year are fetched concurrently (bounded by --workers) and only once per county
+- every successful response is saved in an on-disk cache, so a rerun does not request it again;
+  rate limited (429) and failed requests are retried with backoff and never cached
+- every year is checkpointed: once its rows are built (<year>.pkl) and once they are loaded (<year>.done);
+  a failed run resumes at the first year that is not done
+- the rows of a year replace the rows of that year in the database with a single COPY
+
+NOAA revises a year by publishing a new file (the _c<date> in the file name). The version
+loaded for every year is recorded in the noaa_versions table;
+
+    python -m notebooks.storm_ingest --refresh
+
+ingests again only the years whose version changed (or that were never loaded) and drops
+the dashboard's cached data of those years.
+'''
+import io
+import os
+import re
+import time
+import hashlib
+import argparse
+from urllib.request import urlopen
+from urllib.error import HTTPError
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import psycopg2
+
+from notebooks.data_constants import NOAA_CSVFILES_URL, ZONE_COUNTY_CORR_CSV, TABLE_COLUMNS_NOAA
+from notebooks.data_constants import MIN_DAMAGE, BEGIN_YEAR, END_YEAR, STORM_CATEGORIES
+from notebooks.amazon_cred import ENDPOINT, PORT, USER, PASSWORD, DATABASE
+from notebooks.cred import CENSUS_API_KEY
+
+CENSUS_API_URL = 'https://api.census.gov/data/'
+WORK_DIR = 'data/ingest'
+NUM_WORKERS = 8
+NUM_RETRIES = 5
+HTTP_TIMEOUT = 30
+CENSUS_NO_DATA = (204,) # census api answer for a county without data, cached as an empty body
+RETRY_STATUS = (429, 500, 502, 503, 504) # too many requests and server errors are retried with backoff
+
+NAICS_CODE_DICT = { # North American Industry Classification System Code
+    '11': 'Agriculture, Forestry, Fishing, Hunting',
+    '21': 'Mining',
+    '22': 'Utilities',
+    '23': 'Construction',
+    '31-33': 'Manufacturing',
+    '42': 'Wholesale',
+    '44-45': 'Retail',
+    '48-49': 'Transportation and Warehousing',
+    '51': 'Information',
+    '52': 'Finance and Insurance',
+    '53': 'Real Estate Rental and Leasing',
+    '54': 'Professional, Scientific, and Technical Services',
+    '55': 'Management of Companies and Enterprises',
+    '56': 'Administrative and Support and Waste Management and Remediation Services',
+    '61': 'Educational Services',
+    '62': 'Health Care and Social Assistance',
+    '71': 'Arts, Entertainment, and Recreation',
+    '72': 'Accommodation and Food Services',
+    '81': 'Other Services (except Public Administration)',
+    '92': 'Public Administration'
+}
+
+PATTERN = re.compile(r'\[\[|\[|\],|\]\]') # remove square brackets from the response from census api
+
+# columns of the counties table
+TABLE_COLUMNS = TABLE_COLUMNS_NOAA + list(STORM_CATEGORIES.keys()) + ['DATA_COL', 'Year']
+TABLE_SQL_TYPES = {'EVENT_DATE': 'TIMESTAMP', 'TOTAL_DAMAGE': 'DOUBLE PRECISION', 'DURATION': 'BIGINT',
+                   'Year': 'BIGINT'}
+TABLE_SQL_TYPES.update({k: 'BOOLEAN' for k in STORM_CATEGORIES.keys()})
+
+class ResponseCache:
+    '''
+    HTTP GET with an on-disk cache of the response body.
+    The census api key is not part of the cache key. An empty body is only cached for the
+    "no data" statuses listed in no_data (none for a NOAA file); 429, server and network errors
+    are retried with backoff and then raised, any other error (e.g. 401/403 for a bad key,
+    404) is raised at once.
+    '''
+    def __init__(self, cache_dir, retries=NUM_RETRIES, timeout=HTTP_TIMEOUT):
+        self.cache_dir = cache_dir
+        self.retries = retries
+        self.timeout = timeout
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, url):
+        url = re.sub(r'&key=[^&]*', '', url)
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def get(self, url, no_data=CENSUS_NO_DATA):
+        path = self.path(url)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                return f.read()
+
+        for attempt in range(self.retries):
+            delay = 2**attempt
+            try:
+                with urlopen(url, timeout=self.timeout) as response:
+                    status = response.status
+                    content = response.read() # a 204 has an empty body
+                break
+            except HTTPError as err:
+                if err.code not in RETRY_STATUS or attempt == self.retries - 1:
+                    raise
+                retry_after = err.headers.get('Retry-After', '')
+                if retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+            except OSError: # URLError, timeout, connection reset
+                if attempt == self.retries - 1:
+                    raise
+            time.sleep(delay)
+
+        if len(content) == 0 and status not in no_data:
+            raise ValueError(f'empty response from {url}')
+        tmp_path = path + '.tmp' # write and rename so that a partial file is never read back
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        return content
+
+    def get_all(self, urls, workers=NUM_WORKERS):
+        # dict url: content; at most `workers` requests are in flight at a time
+        urls = list(dict.fromkeys(urls))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return dict(zip(urls, executor.map(self.get, urls)))
+
+def parse_census(content):
+    # census api responds with a json list of lists; strip the brackets and read it as csv
+    if content is None or len(content) == 0:
+        return None
+    content = re.sub(PATTERN, '', content.decode('utf-8'))
+    return pd.read_csv(io.StringIO(content), quotechar='"')
+
+def get_list_csvfiles(url):
+    html = pd.read_html(url) # read_html and then get the list of files from the html table
+    df = html[0]
+    df.drop(columns=['Description'], inplace=True)
+    df.dropna(inplace=True)
+    df = df[df['Name'].str.contains('StormEvents_details.*d20', regex=True)]
+
+    files_dict = {}
+    for fname in df['Name']:
+        result = re.findall(r'_d(?P<year>\d{4})', fname) # parse the year from the file name
+        if len(result) > 0:
+            files_dict[result[0]] = fname # dict key is the year, value is the filename
+    return files_dict
+
+def get_file_version(fname):
+    # StormEvents_details-ftp_v1.0_d<year>_c<date>.csv.gz, the version is the date
+    result = re.findall(r'_c(?P<version>\d{8})', fname)
+    return result[0] if len(result) > 0 else fname
+
+def convert_damage(s):
+    # 3.00K --> 3000.0, K --> 1000.0, NaN or anything else --> 0.0
+    s = s.fillna('').astype(str).str.strip()
+    mult = s.str[-1:].str.upper().map({'K': 1_000.0, 'M': 1_000_000.0, 'B': 1_000_000_000.0})
+    num = pd.to_numeric(s.str[:-1].replace('', '1'), errors='coerce')
+    return (num * mult).fillna(0.0)
+
+def get_storm_events(content, fname, zone_county_df):
+    df = pd.read_csv(io.BytesIO(content), compression='gzip' if fname.endswith('.gz') else None)
+
+    # 1. Drop rows that have STATE_FIPS = Nan or CZ_FIPS = Nan
+    df = df.dropna(subset=['STATE_FIPS', 'CZ_FIPS'])
+    df['STATE_FIPS'] = df['STATE_FIPS'].astype(int)
+    df['CZ_FIPS'] = df['CZ_FIPS'].astype(int)
+
+    # 2. Convert DAMAGE_PROPERTY, DAMAGE_CROPS to numbers (replace Nan with 0)
+    df['DAMAGE_PROPERTY'] = convert_damage(df['DAMAGE_PROPERTY'])
+    df['DAMAGE_CROPS'] = convert_damage(df['DAMAGE_CROPS'])
+
+    # 3. Select only counties in 50 US states and Washington DC (FIPS ID for Wyoming is 56)
+    # 4. DAMAGE_PROPERTY + DAMAGE_CROPS >= min_damage
+    df = df[(df['STATE_FIPS'] <= 56) & (df['DAMAGE_PROPERTY'] + df['DAMAGE_CROPS'] >= MIN_DAMAGE)]
+    df = df.reset_index(drop=True)
+
+    # 5. Update the county FIPS for each record
+    # when CZ_TYPE is 'C', the record covers a single county
+    df_c = df[df['CZ_TYPE'] == 'C'].copy()
+    df_c['FIPS'] = df_c['STATE_FIPS']*1000 + df_c['CZ_FIPS']
+    # otherwise get the county FIPS for each county that is in the zone
+    # and split the damage across counties evenly
+    df_z = df[df['CZ_TYPE'] != 'C'].reset_index()
+    df_z = df_z.merge(zone_county_df[['STATE_FIPS', 'ZONE', 'FIPS']],
+                      left_on=['STATE_FIPS', 'CZ_FIPS'], right_on=['STATE_FIPS', 'ZONE'])
+    num_counties = df_z.groupby('index')['FIPS'].transform('size')
+    df_z['DAMAGE_PROPERTY'] = df_z['DAMAGE_PROPERTY']/num_counties
+    df_z['DAMAGE_CROPS'] = df_z['DAMAGE_CROPS']/num_counties
+    df_z = df_z.set_index('index').drop(columns=['ZONE'])
+
+    df = pd.concat([df_c, df_z]).sort_index(kind='stable').reset_index(drop=True) # keep the order of the events
+    df = df[df['DAMAGE_PROPERTY'] + df['DAMAGE_CROPS'] >= MIN_DAMAGE].copy()
+
+    # 6. Ensure FIPS are 5 characters (for plotly)
+    df['FIPS'] = df['FIPS'].astype(int).astype(str).str.zfill(5)
+
+    # 7. Storm category, event date, name, total damage, duration, tornado strength
+    for k, v in STORM_CATEGORIES.items():
+        df[k] = df['EVENT_TYPE'].str.contains('|'.join(v), regex=True)
+
+    begin_day = df['BEGIN_YEARMONTH'].astype(str) + df['BEGIN_DAY'].astype(str).str.zfill(2)
+    end_day = df['END_YEARMONTH'].astype(str) + df['END_DAY'].astype(str).str.zfill(2)
+    df['EVENT_DATE'] = pd.to_datetime(begin_day, format='%Y%m%d')
+    df['NAME'] = df['CZ_NAME'] + ', ' + df['STATE']
+    df['TOTAL_DAMAGE'] = df['DAMAGE_PROPERTY'] + df['DAMAGE_CROPS']
+    begin_ts = pd.to_datetime(begin_day + df['BEGIN_TIME'].astype(str).str.zfill(4), format='%Y%m%d%H%M')
+    end_ts = pd.to_datetime(end_day + df['END_TIME'].astype(str).str.zfill(4), format='%Y%m%d%H%M')
+    df['DURATION'] = end_ts - begin_ts
+    df['TORNADO_STRENGTH'] = np.where(df['EVENT_TYPE'] == 'Tornado',
+                                      df['TOR_F_SCALE'].astype(str) + ',' +
+                                      df['TOR_LENGTH'].astype(str) + ',' + df['TOR_WIDTH'].astype(str),
+                                      '')
+
+    lst_columns = TABLE_COLUMNS_NOAA + list(STORM_CATEGORIES.keys())
+    return df[lst_columns]
+
+def census_urls(fips, year, census_url, census_api_key):
+    # urls of the census statistics of a county for a given year
+    state = fips[:2]  # state FIPS is the first 2 characters of FIPS
+    county = fips[2:] # county FIPS is the remaining characters of the 5 character FIPS
+    where = f'&for=county:{county}&in=state:{state}&key={census_api_key}'
+    urls = {}
+
+    # Population: decennial census (2000, 2010) before 2009, American Community Survey 5-Year Data after
+    pop_year = min(year, 2019) # last year for which we have data available
+    if pop_year < 2009:
+        urls['pop_2000'] = f'{census_url}2000/dec/sf1?get=NAME,P001001' + where
+        urls['pop_2010'] = f'{census_url}2010/dec/sf1?get=NAME,P001001' + where
+    else:
+        urls['pop'] = f'{census_url}{pop_year}/acs/acs5?get=NAME,B01001_001E' + where
+
+    # County Business Patterns (1986-2019)
+    cbp_year = min(year, 2019)
+    get = 'NAME,ESTAB,PAYANN,EMP' if cbp_year >= 2015 else 'ESTAB,PAYANN,EMP'
+    urls['cbp'] = f'{census_url}{cbp_year}/cbp?get={get}' + where
+
+    # Nonemployer Statistics (1997-2018)
+    neb_year = min(year, 2018)
+    get = 'NAME,NESTAB,NRCPTOT' if neb_year >= 2015 else 'NESTAB,NRCPTOT'
+    urls['neb'] = f'{census_url}{neb_year}/nonemp?get={get}' + where
+
+    # Economic Census (2017, 2012, 2007, 2002)
+    eco_year, dataset = economic_census(year)
+    get = f'NAICS{eco_year},ESTAB,EMP,RCPTOT' + ('' if eco_year == 2017 else ',OPTAX')
+    code_list = ''.join(f'&NAICS{eco_year}={code}' for code in NAICS_CODE_DICT.keys())
+    urls['eco'] = f'{census_url}{eco_year}/{dataset}?get={get}&for=county:{county}&in=state:{state}' + \
+                  code_list + f'&key={census_api_key}'
+    return urls
+
+def economic_census(year):
+    if year >= 2017:
+        return 2017, 'ecnbasic'
+    elif year >= 2012:
+        return 2012, 'ewks'
+    elif year >= 2007:
+        return 2007, 'ewks'
+    return 2002, 'ewks'
+
+def build_data_col(year, urls, responses):
+    # list of values in the same order as the features shown in the dashboard
+    data_col = []
+
+    if 'pop' in urls:
+        df = parse_census(responses[urls['pop']])
+        data_col.append(str(df.iloc[0]['B01001_001E']) if df is not None else 'NaN')
+    else: # interpolate the population for years between 2001 and 2008 from population from year 2000 and 2010
+        df = parse_census(responses[urls['pop_2000']])
+        df_2010 = parse_census(responses[urls['pop_2010']])
+        if df is not None and df_2010 is not None:
+            pop_2000 = df.iloc[0]['P001001']
+            pop_2010 = df_2010.iloc[0]['P001001']
+            data_col.append(str(pop_2000 + (year - 2000)*((pop_2010 - pop_2000)//10)))
+        else:
+            data_col.append('NaN')
+
+    data_col.append(' ') # empty string to separate the heading: 'County Business Patterns'
+    df = parse_census(responses[urls['cbp']])
+    if df is not None:
+        data_col.extend([str(df.iloc[0]['ESTAB']), str(df.iloc[0]['PAYANN']), str(df.iloc[0]['EMP'])])
+    else:
+        data_col.extend(['NaN']*3)
+
+    data_col.append(' ') # empty string to separate the heading: 'Nonemployer Statistics'
+    df = parse_census(responses[urls['neb']])
+    if df is not None:
+        data_col.extend([str(df.iloc[0]['NESTAB']), str(df.iloc[0]['NRCPTOT'])])
+    else:
+        data_col.extend(['NaN']*2)
+
+    data_col.append(' ') # empty string to separate the heading: 'Economic Data'
+    df_eco = parse_census(responses[urls['eco']])
+    if df_eco is not None:
+        code_col = f'NAICS{economic_census(year)[0]}'
+        df_eco = df_eco[[code_col, 'ESTAB', 'EMP', 'RCPTOT']]
+        df_eco = df_eco.groupby([code_col], as_index=False).sum()
+        df_eco.sort_values('RCPTOT', ascending=False, inplace=True)
+        for i in range(3): # top 3 industries in the county
+            if df_eco.shape[0] > i:
+                data_col.extend([NAICS_CODE_DICT[str(df_eco.iloc[i][code_col])],
+                                 str(df_eco.iloc[i]['RCPTOT']),
+                                 str(df_eco.iloc[i]['ESTAB']),
+                                 str(df_eco.iloc[i]['EMP'])])
+            else:
+                data_col.extend(['NaN']*4)
+    else:
+        data_col.extend(['NaN']*12)
+    return '|'.join(data_col)
+
+def add_census_data(df_counties, year, http, census_url, census_api_key, workers=NUM_WORKERS):
+    # the census statistics are per county, request them once for every county of the year
+    county_urls = {fips: census_urls(fips, year, census_url, census_api_key)
+                   for fips in df_counties['FIPS'].unique()}
+    responses = http.get_all([url for urls in county_urls.values() for url in urls.values()], workers)
+    data_col = {fips: build_data_col(year, urls, responses) for fips, urls in county_urls.items()}
+
+    df_counties = df_counties.copy()
+    df_counties['DATA_COL'] = df_counties['FIPS'].map(data_col)
+    df_counties['Year'] = year
+    return df_counties
+
+def create_table(conn):
+    columns = ', '.join(f'"{c}" {TABLE_SQL_TYPES.get(c, "TEXT")}' for c in TABLE_COLUMNS)
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute(f'CREATE TABLE IF NOT EXISTS counties ({columns})')
+            cur.execute('CREATE TABLE IF NOT EXISTS noaa_versions '
+                        '("Year" BIGINT PRIMARY KEY, "FILE_NAME" TEXT, "VERSION" TEXT)')
+
+def get_loaded_versions(conn):
+    # dict year: version of the NOAA file that was loaded
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute('SELECT "Year", "VERSION" FROM noaa_versions')
+            return dict(cur.fetchall())
+
+def load_year(conn, df_counties, year, fname):
+    # replace the rows of the year with a single COPY and record the version in one transaction
+    df = df_counties[TABLE_COLUMNS].copy()
+    df['DURATION'] = df['DURATION'].astype('int64') # nanoseconds
+    buf = io.StringIO()
+    df.to_csv(buf, index=False, header=False)
+    buf.seek(0)
+
+    columns = ', '.join(f'"{c}"' for c in TABLE_COLUMNS)
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute('DELETE FROM counties WHERE "Year" = %s', (year,))
+            cur.copy_expert(f'COPY counties ({columns}) FROM STDIN WITH (FORMAT csv)', buf)
+            cur.execute('INSERT INTO noaa_versions ("Year", "FILE_NAME", "VERSION") VALUES (%s, %s, %s) '
+                        'ON CONFLICT ("Year") DO UPDATE SET "FILE_NAME" = EXCLUDED."FILE_NAME", '
+                        '"VERSION" = EXCLUDED."VERSION"', (year, fname, get_file_version(fname)))
+
+def ingest(conn, years, work_dir=WORK_DIR, noaa_url=NOAA_CSVFILES_URL, census_url=CENSUS_API_URL,
+           zone_county_csv=ZONE_COUNTY_CORR_CSV, census_api_key='', workers=NUM_WORKERS,
+           refresh=False, on_year_loaded=None):
+    http = ResponseCache(os.path.join(work_dir, 'http'))
+    checkpoint_dir = os.path.join(work_dir, 'checkpoints')
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    create_table(conn)
+
+    files_dict = get_list_csvfiles(noaa_url)
+    years = [year for year in years if str(year) in files_dict]
+    if refresh: # only the years whose NOAA file changed since they were loaded
+        loaded = get_loaded_versions(conn)
+        years = [year for year in years if loaded.get(year) != get_file_version(files_dict[str(year)])]
+        print(f'years to refresh: {years}')
+
+    zone_county_df = None
+    for year in years:
+        # checkpoints are per version of the NOAA file of the year
+        fname = files_dict[str(year)]
+        checkpoint = os.path.join(checkpoint_dir, f'{year}_c{get_file_version(fname)}')
+        if os.path.exists(checkpoint + '.done') and not refresh:
+            print(f'{year}: already loaded')
+            continue
+
+        if os.path.exists(checkpoint + '.pkl'):
+            df_counties = pd.read_pickle(checkpoint + '.pkl')
+        else:
+            if zone_county_df is None:
+                zone_county_df = pd.read_csv(zone_county_csv)
+            df_counties = get_storm_events(http.get(noaa_url + fname, no_data=()), fname, zone_county_df)
+            df_counties = add_census_data(df_counties, year, http, census_url, census_api_key, workers)
+            df_counties.to_pickle(checkpoint + '.pkl')
+
+        load_year(conn, df_counties, year, fname)
+        open(checkpoint + '.done', 'w').close()
+        if on_year_loaded is not None:
+            on_year_loaded(year)
+        print(f'{year}: {df_counties.shape[0]} rows loaded from {fname}')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build the counties table from NOAA storm events and census data')
+    parser.add_argument('--years', nargs=2, type=int, default=[BEGIN_YEAR, END_YEAR],
+                        metavar=('BEGIN', 'END'), help='years to ingest, END is excluded')
+    parser.add_argument('--work-dir', default=WORK_DIR, help='response cache and checkpoints')
+    parser.add_argument('--workers', type=int, default=NUM_WORKERS, help='concurrent census requests')
+    parser.add_argument('--noaa-url', default=NOAA_CSVFILES_URL)
+    parser.add_argument('--census-url', default=CENSUS_API_URL)
+    parser.add_argument('--zone-county-csv', default=ZONE_COUNTY_CORR_CSV)
+    parser.add_argument('--dsn', help='postgres connection string, defaults to the amazon RDS database')
+    parser.add_argument('--refresh', action='store_true',
+                        help='ingest only the years whose NOAA file version changed')
+    args = parser.parse_args(argv)
+
+    on_year_loaded = None
+    if args.refresh:
+        from app_df import invalidate_year # drop the dashboard's cached data of a refreshed year
+        on_year_loaded = invalidate_year
+
+    if args.dsn:
+        conn = psycopg2.connect(args.dsn)
+    else:
+        conn = psycopg2.connect(host=ENDPOINT, port=PORT, user=USER, password=PASSWORD, database=DATABASE)
+
+    try:
+        ingest(conn, range(*args.years), work_dir=args.work_dir, noaa_url=args.noaa_url,
+               census_url=args.census_url, zone_county_csv=args.zone_county_csv,
+               census_api_key=CENSUS_API_KEY, workers=args.workers,
+               refresh=args.refresh, on_year_loaded=on_year_loaded)
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+'''
+Feature matrices and damage models of the analysis notebook (noaa_storm_analysis.ipynb).
+
+    python -m notebooks.storm_models --n-jobs -1
+
+- the feature matrices of the 3 storm categories are built once per version of the data:
+  they are saved in an on-disk cache keyed by a hash of the content of the counties table and the CPI
+- the transforms (inflation, log, tornado strength, one hot encoding, scaling) work on whole columns
+- the model fits and the grid search run in parallel; the time taken by every fit is recorded
+- events of a month without CPI data fail the build (or are dropped with --drop-missing-cpi)
+
+Needs scikit-learn and joblib (notebooks/requirements.txt), which the dashboards do not use.
+'''
+import os
+import time
+import hashlib
+import argparse
+
+import numpy as np
+import pandas as pd
+import psycopg2
+from joblib import Parallel, delayed, dump, load
+
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+from sklearn.model_selection import train_test_split, cross_val_score, GridSearchCV
+from sklearn.decomposition import PCA
+from sklearn.metrics import mean_squared_error
+from sklearn.linear_model import LinearRegression
+from sklearn.tree import DecisionTreeRegressor
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.svm import SVR
+from sklearn.neighbors import KNeighborsRegressor
+
+from notebooks.data_constants import BLS_CPI_CSV
+from notebooks.amazon_cred import ENDPOINT, PORT, USER, PASSWORD, DATABASE
+
+FEATURES_VERSION = 1 # bump when the feature transforms change, the cached matrices are then rebuilt
+CACHE_DIR = 'data/features'
+RANDOM_STATE = 42
+
+# Split the DATA_COL into individual columns; ' ' separates the headings in DATA_COL
+DATA_COL_POSITIONS = [0, 2, 3, 4, 6, 7] + list(range(9, 21))
+DATA_COLS = [
+    'population', 'num_estab', 'annual_payroll', 'num_emp', 'num_non_emp_estb', 'non_emp_revenue',
+    'rank_1_ind', 'rank_1_biz_val', 'rank_1_estab', 'rank_1_emp',
+    'rank_2_ind', 'rank_2_biz_val', 'rank_2_estab', 'rank_2_emp',
+    'rank_3_ind', 'rank_3_biz_val', 'rank_3_estab', 'rank_3_emp'
+]
+NUM_COLS = [c for c in DATA_COLS if not c.endswith('_ind')]
+DOLLAR_COLS = ['TOTAL_DAMAGE', 'annual_payroll', 'non_emp_revenue',
+               'rank_1_biz_val', 'rank_2_biz_val', 'rank_3_biz_val']
+CATEGORY_COLS = ['Tropical Cyclones/Floods', 'Severe Local Storms', 'Wildfires/Droughts']
+CATEGORICAL_ATTRIBUTES = ['EVENT_TYPE', 'EVENT_DATE', 'rank_1_ind', 'rank_2_ind', 'rank_3_ind',
+                          'TORNADO_STRENGTH'] + CATEGORY_COLS
+
+# Remove records which have very few industries
+IND_TO_REMOVE = {
+    'rank_1_ind': ['NaN', 'Administrative and Support and Waste Management and Remediation Services',
+                   'Real Estate Rental and Leasing', 'Arts, Entertainment, and Recreation',
+                   'Other Services (except Public Administration)'],
+    'rank_2_ind': ['Information', 'Finance and Insurance'],
+    'rank_3_ind': ['Finance and Insurance', 'Educational Services', 'NaN']
+}
+
+MODELS = {
+    'Linear regression': lambda: LinearRegression(),
+    'Decision tree regression': lambda: DecisionTreeRegressor(random_state=RANDOM_STATE),
+    'Random forest regression': lambda: RandomForestRegressor(random_state=RANDOM_STATE),
+    'Support vector regression': lambda: SVR(),
+    'KNN regression': lambda: KNeighborsRegressor()
+}
+RF_PARAM_GRID = [{'bootstrap': [False, True], 'n_estimators': [75, 100, 125, 150, 200],
+                  'max_features': [1, 2, 4, 6]}]
+
+def get_counties(conn):
+    with conn:
+        df_counties = pd.read_sql('SELECT * from counties', con=conn)
+    return df_counties
+
+def data_hash(*dfs):
+    # hash of the content of the data frames; the cache key of the feature matrices
+    h = hashlib.sha1(f'features-v{FEATURES_VERSION}'.encode('utf-8'))
+    for df in dfs:
+        h.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+        h.update(','.join(df.columns).encode('utf-8'))
+    return h.hexdigest()
+
+def build_analysis_df(df_counties, df_bls_cpi, missing_cpi='raise'):
+    # missing_cpi: 'raise' or 'drop' the events of a month that is not in the CPI data
+    analysis_df = df_counties[['TOTAL_DAMAGE', 'EVENT_DATE', 'EVENT_TYPE',
+                               'DURATION', 'DATA_COL', 'TORNADO_STRENGTH'] + CATEGORY_COLS]
+    analysis_df = analysis_df[analysis_df[CATEGORY_COLS].any(axis=1)].reset_index(drop=True)
+
+    data_df = analysis_df['DATA_COL'].str.split('|', expand=True)[DATA_COL_POSITIONS]
+    data_df.columns = DATA_COLS
+    analysis_df = pd.concat([analysis_df.drop(columns=['DATA_COL']), data_df], axis=1)
+
+    # Convert columns to numeric data
+    analysis_df[NUM_COLS] = analysis_df[NUM_COLS].apply(pd.to_numeric, errors='coerce')
+    analysis_df[NUM_COLS] = analysis_df[NUM_COLS].fillna(analysis_df[NUM_COLS].median())
+
+    for c, lst_ind in IND_TO_REMOVE.items():
+        analysis_df = analysis_df[~analysis_df[c].isin(lst_ind)]
+    analysis_df = analysis_df.copy()
+
+    # Apply the inflation adjustment (to 2020 dollars) to dollar figures for each event
+    event_date = pd.to_datetime(analysis_df['EVENT_DATE'])
+    cpi = df_bls_cpi.set_index(['year', 'period'])['value']
+    cpi_event = cpi.reindex(pd.MultiIndex.from_arrays([event_date.dt.year, event_date.dt.month])).values
+    cpi_2020 = cpi.reindex(pd.MultiIndex.from_arrays([np.full(len(event_date), 2020), event_date.dt.month])).values
+    missing = np.isnan(cpi_event)
+    if missing.any(): # the log transform below would turn their damage into 0
+        months = sorted(event_date[missing].dt.strftime('%Y-%m').unique())
+        if missing_cpi != 'drop':
+            raise ValueError(f'no CPI for {missing.sum()} events in {months}: update data/bls_cpi.csv '
+                             '(download_bls_cpi_csv in Storm_Database.ipynb) or use --drop-missing-cpi')
+        print(f'Dropping {missing.sum()} events without CPI in {months}')
+        analysis_df = analysis_df[~missing].copy()
+        cpi_event, cpi_2020 = cpi_event[~missing], cpi_2020[~missing]
+    analysis_df[DOLLAR_COLS] = analysis_df[DOLLAR_COLS].mul(cpi_2020/cpi_event, axis=0)
+
+    analysis_df = analysis_df.drop(columns=['EVENT_DATE'])
+    analysis_df['DURATION'] = analysis_df['DURATION']/(60*1e9) # convert the duration in minutes (from nanosec)
+
+    # log-log model
+    lst_num_cols = [c for c in analysis_df.columns if c not in CATEGORICAL_ATTRIBUTES]
+    analysis_df[lst_num_cols] = np.log(analysis_df[lst_num_cols].mask(analysis_df[lst_num_cols] <= 0)).fillna(0)
+    return analysis_df
+
+def split_categories(analysis_df):
+    # Split data into major storm categories: Tropical Cyclones/Floods, Tornadoes, Wildfires
+    cat1_df = analysis_df[analysis_df['Tropical Cyclones/Floods'] == True]
+    cat2_df = analysis_df[analysis_df['EVENT_TYPE'] == 'Tornado']
+    cat3_df = analysis_df[analysis_df['Wildfires/Droughts'] == True]
+
+    cat1_df = cat1_df.drop(columns=['TORNADO_STRENGTH'] + CATEGORY_COLS)
+    cat2_df = cat2_df.drop(columns=['EVENT_TYPE'] + CATEGORY_COLS)
+    cat3_df = cat3_df.drop(columns=['TORNADO_STRENGTH'] + CATEGORY_COLS)
+
+    strength = cat2_df['TORNADO_STRENGTH'].str.split(',', expand=True)
+    cat2_df = cat2_df.drop(columns=['TORNADO_STRENGTH'])
+    cat2_df['Tornado_f_scale'] = strength[0].str[-1].astype(int)
+    cat2_df['Tornado_len'] = strength[1].astype(float)
+    cat2_df['Tornado_width'] = strength[2].astype(float)
+
+    return {'Tropical Storms/Cyclones': cat1_df, 'Tornadoes': cat2_df, 'Wildfires/Droughts': cat3_df}
+
+def build_features(cat_df):
+    # train test split, one hot encoding of the string variables, scaling and PCA
+    X = cat_df.drop(columns=['TOTAL_DAMAGE'])
+    y = cat_df['TOTAL_DAMAGE'].values
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.1, random_state=RANDOM_STATE)
+
+    str_cols = [c for c in ['rank_1_ind', 'rank_2_ind', 'rank_3_ind', 'EVENT_TYPE'] if c in X.columns]
+    ohe = OneHotEncoder(handle_unknown='ignore')
+    X_train = np.hstack([X_train.drop(columns=str_cols).values.astype(float),
+                         ohe.fit_transform(X_train[str_cols]).toarray()])
+    X_test = np.hstack([X_test.drop(columns=str_cols).values.astype(float),
+                        ohe.transform(X_test[str_cols]).toarray()])
+
+    scaler = StandardScaler()
+    X_train = scaler.fit_transform(X_train)
+    X_test = scaler.transform(X_test)
+
+    # select the number of components such that the amount of variance that needs to be explained
+    # is greater than 90%
+    pca = PCA(n_components=0.9, svd_solver='full', random_state=RANDOM_STATE)
+    X_train = pca.fit_transform(X_train)
+    X_test = pca.transform(X_test)
+    return {'X_train': X_train, 'X_test': X_test, 'y_train': y_train, 'y_test': y_test}
+
+def get_feature_sets(df_counties, df_bls_cpi, cache_dir=CACHE_DIR, missing_cpi='raise'):
+    # feature matrices of every storm category; built only once per version of the data
+    os.makedirs(cache_dir, exist_ok=True)
+    key = data_hash(df_counties, df_bls_cpi) + ('-drop' if missing_cpi == 'drop' else '')
+    path = os.path.join(cache_dir, key + '.joblib')
+    if os.path.exists(path):
+        return load(path)
+
+    analysis_df = build_analysis_df(df_counties, df_bls_cpi, missing_cpi)
+    feature_sets = {k: build_features(v) for k, v in split_categories(analysis_df).items()}
+    dump(feature_sets, path + '.tmp')
+    os.replace(path + '.tmp', path)
+    return feature_sets
+
+def fit_model(category, model_name, features):
+    start = time.perf_counter()
+    clf = MODELS[model_name]()
+    clf.fit(features['X_train'], features['y_train'])
+
+    train_rmse = np.sqrt(mean_squared_error(features['y_train'], clf.predict(features['X_train'])))
+    scores = cross_val_score(clf, features['X_train'], features['y_train'],
+                             scoring='neg_mean_squared_error', cv=10)
+    cv_rmse = np.sqrt(-scores)
+    test_rmse = np.sqrt(mean_squared_error(features['y_test'], clf.predict(features['X_test'])))
+    return {'category': category, 'model': model_name, 'train_rmse': train_rmse,
+            'cv_rmse_mean': cv_rmse.mean(), 'cv_rmse_std': cv_rmse.std(), 'test_rmse': test_rmse,
+            'seconds': time.perf_counter() - start}
+
+def train_models(feature_sets, n_jobs=-1):
+    # every (category, model) fit, with its 10 fold cross validation, is a separate job
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(fit_model)(category, model_name, features)
+        for category, features in feature_sets.items() for model_name in MODELS.keys())
+    return pd.DataFrame(results)
+
+def grid_search_RF(feature_sets, n_jobs=-1):
+    # the candidates and folds of a grid search run in parallel
+    results = []
+    for category, features in feature_sets.items():
+        start = time.perf_counter()
+        g_search = GridSearchCV(RandomForestRegressor(random_state=RANDOM_STATE), RF_PARAM_GRID, cv=5,
+                                scoring='neg_mean_squared_error', return_train_score=True, n_jobs=n_jobs)
+        g_search.fit(features['X_train'], features['y_train'])
+        results.append({'category': category, 'best_score': g_search.best_score_,
+                        'best_params': g_search.best_params_,
+                        'test_score': -g_search.best_estimator_.score(features['X_test'], features['y_test']),
+                        'seconds': time.perf_counter() - start})
+    return pd.DataFrame(results)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Train the damage models of the storm categories')
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help='cached feature matrices')
+    parser.add_argument('--n-jobs', type=int, default=-1, help='parallel jobs, -1 uses all cores')
+    parser.add_argument('--no-grid-search', action='store_true')
+    parser.add_argument('--drop-missing-cpi', action='store_true',
+                        help='drop the events of the months that are not in the CPI data instead of failing')
+    parser.add_argument('--dsn', help='postgres connection string, defaults to the amazon RDS database')
+    args = parser.parse_args(argv)
+
+    if args.dsn:
+        conn = psycopg2.connect(args.dsn)
+    else:
+        conn = psycopg2.connect(host=ENDPOINT, port=PORT, user=USER, password=PASSWORD, database=DATABASE)
+    try:
+        df_counties = get_counties(conn)
+    finally:
+        conn.close()
+
+    start = time.perf_counter()
+    feature_sets = get_feature_sets(df_counties, pd.read_csv(BLS_CPI_CSV), args.cache_dir,
+                                    'drop' if args.drop_missing_cpi else 'raise')
+    print(f'Feature matrices: {time.perf_counter() - start:.1f}s')
+
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(train_models(feature_sets, args.n_jobs))
+        if not args.no_grid_search:
+            print(grid_search_RF(feature_sets, args.n_jobs))
+
+if __name__ == '__main__':
+    main()
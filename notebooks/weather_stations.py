@@ -0,0 +1,105 @@
+import numpy as np
+import pandas as pd
+
+EARTH_RADIUS_MILES = 3959
+
+GHCND_STATIONS_COLSPECS = [(0, 11), (12, 20), (21, 30), (31, 37), (38, 40), (41, 71)]
+GHCND_STATIONS_COLUMNS = ['id', 'latitude', 'longitude', 'elevation', 'state', 'name']
+GHCND_INVENTORY_COLSPECS = [(0, 11), (31, 35), (36, 40), (41, 45)]
+GHCND_INVENTORY_COLUMNS = ['id', 'element', 'firstyear', 'lastyear']
+
+def haversine(lat1, lon1, lat2, lon2):
+    '''
+    great circle distance in miles; works on scalars and broadcasts over numpy arrays
+    '''
+    lat1, lon1, lat2, lon2 = map(np.deg2rad, [lat1, lon1, lat2, lon2])
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2)**2
+    c = 2 * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+    return EARTH_RADIUS_MILES * c
+
+class StationIndex:
+    '''
+    k nearest weather stations for a fixed list of stations.
+    The station coordinates are converted to radians once when the index is built;
+    a query for many points at once is a single broadcasted haversine over numpy arrays
+    (done in chunks of points to bound the size of the distance matrix).
+    '''
+    def __init__(self, df_stations, lat_col='latitude', lon_col='longitude'):
+        self.df_stations = df_stations.reset_index(drop=True)
+        self._lat = np.deg2rad(self.df_stations[lat_col].to_numpy(dtype=float))
+        self._lon = np.deg2rad(self.df_stations[lon_col].to_numpy(dtype=float))
+        self._cos_lat = np.cos(self._lat)
+
+    def __len__(self):
+        return self.df_stations.shape[0]
+
+    def query(self, lat, lon, k=3, chunk_size=1024):
+        '''
+        returns (distances in miles, station positions), both of shape (number of points, k)
+        sorted from the nearest to the farthest station
+        '''
+        lat = np.deg2rad(np.atleast_1d(np.asarray(lat, dtype=float)))
+        lon = np.deg2rad(np.atleast_1d(np.asarray(lon, dtype=float)))
+        k = min(k, len(self))
+        num_points = lat.shape[0]
+
+        dist = np.empty((num_points, k))
+        idx = np.empty((num_points, k), dtype=np.intp)
+        for start in range(0, num_points, chunk_size):
+            end = start + chunk_size
+            lat_pts = lat[start:end, None]
+            lon_pts = lon[start:end, None]
+            a = np.sin((self._lat - lat_pts)/2)**2 + \
+                np.cos(lat_pts) * self._cos_lat * np.sin((self._lon - lon_pts)/2)**2
+            d = 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+            if k < len(self): # only the k smallest distances need to be sorted
+                part = np.argpartition(d, k-1, axis=1)[:, :k]
+            else:
+                part = np.broadcast_to(np.arange(k), d.shape)
+            d_part = np.take_along_axis(d, part, axis=1)
+            order = np.argsort(d_part, axis=1)
+            idx[start:end] = np.take_along_axis(part, order, axis=1)
+            dist[start:end] = np.take_along_axis(d_part, order, axis=1)
+        return dist, idx
+
+    def nearest(self, df_points, k=3, lat_col='LAT', lon_col='LON'):
+        '''
+        k nearest stations for every row in df_points in one call;
+        returns k rows per point (indexed by the point's index) with the station columns,
+        the distance in miles 'hav' and the 'rank' of the station (0 is the nearest)
+        '''
+        dist, idx = self.query(df_points[lat_col], df_points[lon_col], k)
+        k = idx.shape[1]
+        df = self.df_stations.iloc[idx.ravel()].reset_index(drop=True)
+        df['hav'] = dist.ravel()
+        df['rank'] = np.tile(np.arange(k), df_points.shape[0])
+        df.index = np.repeat(df_points.index.values, k)
+        return df
+
+def closestn(df_stations, county, n=3):
+    # nearest n stations to a single county (a row with LAT, LON)
+    df_county = pd.DataFrame([[county['LAT'], county['LON']]], columns=['LAT', 'LON'])
+    return StationIndex(df_stations).nearest(df_county, k=n).reset_index(drop=True)
+
+def load_ghcnd_stations(url):
+    # fixed width list of all GHCN daily stations: ghcnd-stations.txt
+    return pd.read_fwf(url, colspecs=GHCND_STATIONS_COLSPECS, header=None,
+                       names=GHCND_STATIONS_COLUMNS, dtype={'id': str})
+
+def load_ghcnd_inventory(url):
+    # fixed width period of record of every element of a station: ghcnd-inventory.txt
+    return pd.read_fwf(url, colspecs=GHCND_INVENTORY_COLSPECS, header=None,
+                       names=GHCND_INVENTORY_COLUMNS, dtype={'id': str})
+
+def stations_with_records(df_stations, df_inventory, first_year, last_year,
+                          elements=('PRCP', 'TMAX', 'TMIN')):
+    # stations that have a record of every element for the years first_year..last_year
+    df_inv = df_inventory[df_inventory['element'].isin(elements) &
+                          (df_inventory['firstyear'] <= first_year) &
+                          (df_inventory['lastyear'] >= last_year)]
+    num_elements = df_inv.groupby('id')['element'].nunique()
+    ids = num_elements[num_elements == len(elements)].index
+    return df_stations[df_stations['id'].isin(ids)]
@@ -0,0 +1,33 @@
+import threading
+from urllib.parse import urlsplit
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+class StubHandler(BaseHTTPRequestHandler):
+    # routes: path (without the query string) -> list of (status, body); the last one is repeated
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        self.server.requests.append(self.path)
+        responses = self.server.routes.get(path, [(404, b'')])
+        status, body = responses.pop(0) if len(responses) > 1 else responses[0]
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def stub_http():
+    # local http server standing in for NOAA and the census api
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.routes = {}
+    server.requests = []
+    server.url = f'http://127.0.0.1:{server.server_port}'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,131 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('dash')
+import dash_html_components as html
+import api
+from app import app, server
+from notebooks.data_constants import STORM_CATEGORIES
+
+NUM_EVENTS = 2500
+CATEGORIES = list(STORM_CATEGORIES.keys())
+
+def storm_data(year, inflation):
+    # stand-in for app_df.get_storm_data: NUM_EVENTS events over 500 counties
+    rng = np.random.default_rng(int(year))
+    fips = [f'{6000 + i % 500:05d}' for i in range(NUM_EVENTS)]
+    event_type = rng.choice(['Flood', 'Tornado', 'Wildfire'], NUM_EVENTS)
+    df_counties = pd.DataFrame({'NAME': [f'COUNTY {f}, CALIFORNIA' for f in fips], 'FIPS': fips,
+                                'STATE': 'CALIFORNIA', 'EVENT_TYPE': event_type,
+                                'EVENT_DATE': pd.Timestamp(f'{year}-01-01') + pd.to_timedelta(rng.integers(0, 365, NUM_EVENTS), 'D'),
+                                'TOTAL_DAMAGE': rng.uniform(1e6, 1e8, NUM_EVENTS),
+                                'TORNADO_STRENGTH': np.where(event_type == 'Tornado', 'F2,5.0,200.0', None),
+                                'DURATION': 3_600_000_000_000})
+    for c, v in STORM_CATEGORIES.items():
+        df_counties[c] = df_counties['EVENT_TYPE'].str.contains('|'.join(v))
+
+    df_map = df_counties.groupby('FIPS', as_index=False).agg(NAME=('NAME', 'first'), TOTAL_DAMAGE=('TOTAL_DAMAGE', 'sum'),
+                                                            **{c: (c, 'any') for c in CATEGORIES})
+    for i, c in enumerate(CATEGORIES):
+        df_map[f'TYPE_{i}_DAMAGE'] = df_counties[df_counties[c]].groupby('FIPS')['TOTAL_DAMAGE'].sum() \
+                                         .reindex(df_map['FIPS']).fillna(0).values
+    if inflation: # like get_storm_data, only the county totals are adjusted, the events are nominal
+        damage_columns = ['TOTAL_DAMAGE'] + [f'TYPE_{i}_DAMAGE' for i in range(len(CATEGORIES))]
+        df_map[damage_columns] = df_map[damage_columns] * 1.1
+    return df_map, df_counties, None
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(api, 'get_storm_data', storm_data)
+    monkeypatch.setattr(api, 'get_list_years', lambda: {'2000': '', '2019': ''}.keys())
+    if app.layout is None: # set by index.py, which needs the database; dash checks it on the first request
+        app.layout = html.Div()
+    return server.test_client()
+
+def get_ok(client, url, **kwargs):
+    resp = client.get(url, **kwargs)
+    assert resp.status_code == 200, resp.get_data(as_text=True)
+    assert resp.headers['Cache-Control'] in ('public, max-age=3600', 'max-age=3600, public')
+    assert resp.headers['ETag']
+    return resp
+
+def test_events_pagination(client):
+    body = get_ok(client, '/api/v1/events?year=2019&page=2&page_size=1000').get_json()
+    assert body['columns'] == api.EVENT_COLUMNS
+    assert (body['page'], body['page_size'], body['total'], body['pages']) == (2, 1000, NUM_EVENTS, 3)
+    assert all(len(v) == 1000 for v in body['data'].values())
+
+    body = get_ok(client, '/api/v1/events?year=2019&page=3&page_size=1000').get_json()
+    assert len(body['data']['FIPS']) == NUM_EVENTS - 2000
+
+    body = get_ok(client, '/api/v1/events?year=2019&category=Severe%20Local%20Storms&fips=6007').get_json()
+    assert set(body['data']['FIPS']) <= {'06007'}
+    assert set(body['data']['EVENT_TYPE']) <= {'Tornado'}
+
+    # the damage of an event is nominal
+    nominal = get_ok(client, '/api/v1/events?year=2019&page=1&page_size=1000&inflation=0').get_json()
+    body = get_ok(client, '/api/v1/events?year=2019&page=1&page_size=1000').get_json()
+    assert body['data']['TOTAL_DAMAGE'] == nominal['data']['TOTAL_DAMAGE']
+
+def test_county_damage(client):
+    body = get_ok(client, '/api/v1/counties/damage?year=2019&page_size=50').get_json()
+    assert body['columns'] == ['FIPS', 'NAME', 'TOTAL_DAMAGE']
+    assert (body['total'], body['pages']) == (500, 10)
+    damage = body['data']['TOTAL_DAMAGE']
+    assert damage == sorted(damage, reverse=True)
+
+    nominal = get_ok(client, '/api/v1/counties/damage?year=2019&category=Wildfires/Droughts&inflation=0').get_json()
+    assert nominal['data']['TOTAL_DAMAGE'][0] < body['data']['TOTAL_DAMAGE'][0]
+
+def test_wildfires_and_weather(client):
+    body = get_ok(client, '/api/v1/wildfires?year=2019').get_json()
+    assert body['columns'] == ['EVENT_ID', 'NAME', 'FIPS', 'EVENT_DATE', 'TOTAL_DAMAGE']
+    assert len(set(body['data']['EVENT_ID'])) == body['total']
+
+    body = get_ok(client, '/api/v1/wildfires/2000/05_04_35028/weather').get_json() # data/wildfires
+    assert body['columns'] == ['YEAR', 'PRCP', 'TMAX_MEAN', 'TMIN_MEAN', 'TMAX_MAX', 'DAYS']
+    assert body['data']['YEAR'][0] == 1990
+
+def test_bad_requests(client):
+    for url in ['/api/v1/events?year=1999', '/api/v1/events?year=2019&category=Volcano',
+                '/api/v1/events?year=2019&page=0', '/api/v1/events?year=2019&page_size=100000',
+                '/api/v1/wildfires/2000/bad/weather', '/api/v1/wildfires/2000/01_01_99999/weather']:
+        resp = client.get(url)
+        assert resp.status_code == 400, url
+        assert 'error' in resp.get_json()
+
+def test_etag_round_trip(client):
+    resp = get_ok(client, '/api/v1/counties/damage?year=2019')
+    etag = resp.headers['ETag']
+    resp = client.get('/api/v1/counties/damage?year=2019', headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+    assert resp.get_data() == b''
+    resp = client.get('/api/v1/counties/damage?year=2019&page=2', headers={'If-None-Match': etag})
+    assert resp.status_code == 200 # another page has another etag
+
+def test_load(client):
+    # 8 concurrent clients, each requesting every route; half of the requests revalidate an etag
+    urls = ['/api/v1/years', '/api/v1/events?year=2019&page_size=500', '/api/v1/counties/damage?year=2019',
+            '/api/v1/wildfires?year=2019', '/api/v1/wildfires/2000/05_04_35028/weather']
+    etags = {url: get_ok(client, url).headers['ETag'] for url in urls}
+
+    def run(worker):
+        c = server.test_client()
+        statuses = []
+        for i in range(20):
+            url = urls[i % len(urls)]
+            headers = {'If-None-Match': etags[url]} if (i + worker) % 2 else {}
+            statuses.append(c.get(url, headers=headers).status_code)
+        return statuses
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        statuses = [s for lst in executor.map(run, range(8)) for s in lst]
+    seconds = time.perf_counter() - start
+    print(f'{len(statuses)} requests in {seconds:.2f}s ({len(statuses)/seconds:.0f} requests/s)')
+    assert statuses.count(304) == len(statuses)//2
+    assert statuses.count(200) == len(statuses)//2
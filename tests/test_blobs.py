@@ -0,0 +1,81 @@
+import os
+import gzip
+import json
+import time
+
+import pytest
+
+pytest.importorskip('dash')
+import dash_html_components as html
+from dash.dependencies import Input, Output
+
+import blobs
+from app import app, server
+
+calls = []
+
+@app.callback(Output('blob-test-graph', 'figure'), Input('blob-test-signal', 'data'))
+def blob_test_figure(data):
+    calls.append(data)
+    return {'data': [{'type': 'bar', 'x': [data['year']], 'y': [1]}]}
+
+blobs.blob_callback('blob-test-graph.figure',
+                    lambda data: (f"test/{data['year']}/{data['version']}", data['version']))
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(blobs, 'BLOB_DIR', str(tmp_path))
+    monkeypatch.setattr(blobs, 'cache_found', False)
+    monkeypatch.setattr(blobs, 'blob_index', {})
+    calls.clear()
+    if app.layout is None: # set by index.py, which needs the database; dash checks it on the first request
+        app.layout = html.Div()
+    return server.test_client()
+
+def update(client, year, version, encoding='gzip'):
+    body = {'output': 'blob-test-graph.figure', 'outputs': {'id': 'blob-test-graph', 'property': 'figure'},
+            'inputs': [{'id': 'blob-test-signal', 'property': 'data', 'value': {'year': year, 'version': version}}],
+            'changedPropIds': ['blob-test-signal.data'], 'state': []}
+    resp = client.post(blobs.DASH_UPDATE_URL, json=body, headers={'Accept-Encoding': encoding})
+    assert resp.status_code == 200
+    data = resp.get_data()
+    if resp.headers.get('Content-Encoding') == 'gzip':
+        data = gzip.decompress(data)
+    figure = json.loads(data)['response']['blob-test-graph']['figure']
+    assert figure['data'][0]['x'] == [year]
+    return resp
+
+def test_response_saved_once(client):
+    first = update(client, 2019, '20220425')
+    second = update(client, 2019, '20220425')
+    assert calls == [{'year': 2019, 'version': '20220425'}] # the second response is the blob
+    assert second.headers['Content-Encoding'] == 'gzip'
+    assert second.headers['Vary'] == 'Accept-Encoding'
+    assert second.get_data() == first.get_data()
+
+    identity = update(client, 2019, '20220425', encoding='')
+    assert 'Content-Encoding' not in identity.headers
+    assert gzip.decompress(first.get_data()) == identity.get_data()
+
+    update(client, 2020, '20220425')
+    assert len(calls) == 2
+
+def test_unversioned_blob_expires(client, monkeypatch):
+    update(client, 2019, '')
+    update(client, 2019, '')
+    assert len(calls) == 1
+    now = time.time()
+    monkeypatch.setattr(blobs.time, 'time', lambda: now + blobs.cache.cache.default_timeout + 1)
+    update(client, 2019, '')
+    assert len(calls) == 2
+    update(client, 2019, '20220425') # a versioned blob does not expire
+    update(client, 2019, '20220425')
+    assert len(calls) == 3
+
+def test_blob_missing_on_disk(client, tmp_path):
+    # e.g. another instance saved the blob: the callback runs again instead of a blank graph
+    update(client, 2019, '20220425')
+    for name in os.listdir(tmp_path):
+        os.remove(os.path.join(tmp_path, name))
+    update(client, 2019, '20220425')
+    assert len(calls) == 2
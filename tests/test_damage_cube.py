@@ -0,0 +1,67 @@
+import os
+import time
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('dash')
+import app_df
+
+def counties(damage):
+    # two events in 2019 in Los Angeles county and one in 2022, after the last month of cpi data
+    return pd.DataFrame({'FIPS': ['06037', '06037', '06037'],
+                         'EVENT_DATE': pd.to_datetime(['2019-03-10', '2019-08-01', '2022-02-01']),
+                         'TOTAL_DAMAGE': [damage, 1_000_000.0, 1_000_000.0], 'Year': [2019, 2019, 2022],
+                         'Tropical Cyclones/Floods': [True, False, False],
+                         'Severe Local Storms': [False, True, False], 'Wildfires/Droughts': [False, False, True]})
+
+@pytest.fixture
+def cube_data(tmp_path, monkeypatch):
+    # the counties table and its key; the cpi ends at 2021-08 like data/bls_cpi.csv
+    data = {'key': 'a', 'df': counties(2_000_000.0)}
+    df_cpi = pd.DataFrame([(y, m, 100.0 + (y - 2019)*12 + m) for y in [2019, 2020, 2021] for m in range(1, 13)
+                           if (y, m) <= (2021, 8)], columns=['year', 'period', 'value'])
+    monkeypatch.setattr(app_df, 'DAMAGE_CUBE_DIR', str(tmp_path))
+    monkeypatch.setattr(app_df, 'damage_cube', None)
+    monkeypatch.setattr(app_df, 'cube_builder', None)
+    monkeypatch.setattr(app_df, 'get_cube_key', lambda: data['key'])
+    monkeypatch.setattr(app_df, 'get_cube_data', lambda: data['df'])
+    monkeypatch.setattr(app_df, 'get_bls_cpi', lambda: df_cpi)
+    return data
+
+def test_county_trend(cube_data):
+    df = app_df.get_county_trend('06037', 'all', inflation=False)
+    assert df.set_index('YEAR').loc[2019].tolist() == [3_000_000.0, 2]
+    assert df.set_index('YEAR').loc[2022].tolist() == [1_000_000.0, 1]
+    df = app_df.get_county_trend('06037', 'Severe Local Storms', inflation=True)
+    assert df.set_index('YEAR').loc[2019, 'DAMAGE'] == pytest.approx(1_000_000.0*120/108)
+    assert app_df.get_county_trend('06059') is None
+
+def test_missing_cpi_uses_last_month(cube_data):
+    df = app_df.get_county_trend('06037', 'Wildfires/Droughts', inflation=True)
+    assert not df['DAMAGE'].isna().any()
+    assert df.set_index('YEAR').loc[2022, 'DAMAGE'] == pytest.approx(1_000_000.0*114/132) # cpi of 2021-08
+
+def test_cube_rebuilt_when_data_changes(cube_data, tmp_path):
+    assert app_df.get_county_trend('06037', inflation=False)['DAMAGE'].max() == 3_000_000.0
+    cube_data['df'] = counties(5_000_000.0)
+    # same key: the memory mapped cube is used
+    assert app_df.get_county_trend('06037', inflation=False)['DAMAGE'].max() == 3_000_000.0
+    cube_data['key'] = 'b' # e.g. another host ingested a year
+    # the old cube is served while the new one is built in the background
+    assert app_df.get_county_trend('06037', inflation=False)['DAMAGE'].max() == 3_000_000.0
+    app_df.cube_builder.join()
+    assert app_df.get_county_trend('06037', inflation=False)['DAMAGE'].max() == 6_000_000.0
+    assert os.listdir(tmp_path) == ['b'] # the cube of the old data is removed
+
+def test_cube_key_memoized_without_redis(monkeypatch):
+    # every trend click reads the key; without redis the query runs once per timeout in the process
+    monkeypatch.setattr(app_df, 'cache_found', False)
+    now = time.time()
+    monkeypatch.setattr(app_df.time, 'time', lambda: now)
+    queries = []
+    get_key = app_df.cache_memoize_timed(lambda: queries.append(1) or len(queries))
+    assert get_key() == 1
+    assert get_key() == 1
+    monkeypatch.setattr(app_df.time, 'time', lambda: now + app_df.cache.cache.default_timeout + 1)
+    assert get_key() == 2
@@ -0,0 +1,157 @@
+import os
+import gzip
+from urllib.error import HTTPError
+
+import pandas as pd
+import pytest
+
+from notebooks import storm_ingest
+from notebooks.storm_ingest import ResponseCache
+
+EVENT_COLUMNS = ['STATE_FIPS', 'STATE', 'CZ_TYPE', 'CZ_FIPS', 'CZ_NAME', 'EVENT_TYPE',
+                 'BEGIN_YEARMONTH', 'BEGIN_DAY', 'BEGIN_TIME', 'END_YEARMONTH', 'END_DAY', 'END_TIME',
+                 'DAMAGE_PROPERTY', 'DAMAGE_CROPS', 'TOR_F_SCALE', 'TOR_LENGTH', 'TOR_WIDTH']
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(storm_ingest.time, 'sleep', lambda seconds: None)
+
+def noaa_file(year):
+    # a county event and a zone event that covers two counties
+    df = pd.DataFrame([[6, 'CALIFORNIA', 'C', 37, 'LOS ANGELES', 'Flash Flood',
+                        year*100 + 1, 9, 1200, year*100 + 1, 10, 600, '2.00M', '0.00K', None, None, None],
+                       [6, 'CALIFORNIA', 'Z', 41, 'SOUTH COAST', 'Wildfire',
+                        year*100 + 10, 2, 800, year*100 + 10, 5, 1800, '4.00M', '0', None, None, None]],
+                      columns=EVENT_COLUMNS)
+    return gzip.compress(df.to_csv(index=False).encode('utf-8'))
+
+def noaa_listing(fnames):
+    # directory listing of NOAA_CSVFILES_URL
+    rows = ''.join(f'<tr><td><a href="{f}">{f}</a></td><td>2022-04-25 10:00</td><td>1.2M</td><td></td></tr>'
+                   for f in fnames)
+    return ('<html><body><table><tr><th>Name</th><th>Last modified</th><th>Size</th><th>Description</th></tr>'
+            f'{rows}</table></body></html>').encode('utf-8')
+
+def census_body(rows):
+    return ('[' + ',\n'.join('[' + ','.join(f'"{v}"' for v in row) + ']' for row in rows) + ']').encode('utf-8')
+
+def noaa_site(server, versions):
+    # versions: dict year: _c<date> of the NOAA file of that year; census answers for 2019
+    fnames = {year: f'StormEvents_details-ftp_v1.0_d{year}_c{version}.csv.gz' for year, version in versions.items()}
+    server.routes['/noaa/'] = [(200, noaa_listing(fnames.values()))]
+    for year, fname in fnames.items():
+        server.routes['/noaa/' + fname] = [(200, noaa_file(year))]
+    server.routes['/data/2019/acs/acs5'] = [(200, census_body([['NAME', 'B01001_001E', 'state', 'county'],
+                                                                ['A County', '1000', '06', '037']]))]
+    server.routes['/data/2019/cbp'] = [(200, census_body([['NAME', 'ESTAB', 'PAYANN', 'EMP', 'state', 'county'],
+                                                          ['A County', '10', '200', '30', '06', '037']]))]
+    server.routes['/data/2018/nonemp'] = [(204, b'')] # no data for the county
+    server.routes['/data/2017/ecnbasic'] = [(200, census_body([['NAICS2017', 'ESTAB', 'EMP', 'RCPTOT', 'state', 'county'],
+                                                               ['42', '5', '50', '900', '06', '037'],
+                                                               ['31-33', '2', '80', '1500', '06', '037']]))]
+    return fnames
+
+@pytest.fixture
+def zone_county_csv(tmp_path):
+    path = tmp_path / 'zone_county_corr.csv'
+    pd.DataFrame({'STATE_FIPS': [6, 6], 'ZONE': [41, 41], 'FIPS': [6037, 6059]}).to_csv(path, index=False)
+    return str(path)
+
+def test_census_no_data_is_cached(stub_http, tmp_path):
+    http = ResponseCache(str(tmp_path))
+    stub_http.routes['/no-content'] = [(204, b'')]
+    assert http.get(stub_http.url + '/no-content') == b''
+    assert http.get(stub_http.url + '/no-content') == b''
+    assert len(stub_http.requests) == 1 # the second get is read from the cache
+
+    stub_http.routes['/not-found'] = [(404, b'')]
+    with pytest.raises(HTTPError):
+        http.get(stub_http.url + '/not-found')
+    assert not os.path.exists(http.path(stub_http.url + '/not-found'))
+
+def test_too_many_requests_is_retried(stub_http, tmp_path):
+    http = ResponseCache(str(tmp_path))
+    stub_http.routes['/census'] = [(429, b''), (503, b''), (200, b'[["ESTAB"],["10"]]')]
+    assert http.get(stub_http.url + '/census?get=ESTAB&key=secret') == b'[["ESTAB"],["10"]]'
+    assert len(stub_http.requests) == 3
+    assert http.get(stub_http.url + '/census?get=ESTAB&key=other') == b'[["ESTAB"],["10"]]' # key is not cached
+    assert len(stub_http.requests) == 3
+
+def test_client_error_is_not_cached(stub_http, tmp_path):
+    http = ResponseCache(str(tmp_path))
+    stub_http.routes['/census'] = [(403, b'invalid key'), (200, b'[["ESTAB"],["10"]]')]
+    with pytest.raises(HTTPError):
+        http.get(stub_http.url + '/census')
+    assert os.listdir(tmp_path) == []
+    assert http.get(stub_http.url + '/census') == b'[["ESTAB"],["10"]]'
+
+def test_failed_noaa_download_is_not_cached(stub_http, tmp_path):
+    http = ResponseCache(str(tmp_path))
+    url = stub_http.url + '/noaa/StormEvents_details-ftp_v1.0_d2019_c20220425.csv.gz'
+    with pytest.raises(HTTPError):
+        http.get(url, no_data=())
+    stub_http.routes['/noaa/StormEvents_details-ftp_v1.0_d2019_c20220425.csv.gz'] = [(200, noaa_file(2019))]
+    assert http.get(url, no_data=()) == noaa_file(2019)
+
+def test_storm_events_with_census_data(stub_http, tmp_path, zone_county_csv):
+    fnames = noaa_site(stub_http, {2019: '20220425'})
+    http = ResponseCache(str(tmp_path / 'http'))
+    content = http.get(f'{stub_http.url}/noaa/{fnames[2019]}', no_data=())
+    df = storm_ingest.get_storm_events(content, fnames[2019], pd.read_csv(zone_county_csv))
+    assert df['FIPS'].tolist() == ['06037', '06037', '06059']
+    assert df['TOTAL_DAMAGE'].tolist() == [2_000_000.0, 2_000_000.0, 2_000_000.0] # zone damage split evenly
+
+    df = storm_ingest.add_census_data(df, 2019, http, stub_http.url + '/data/', 'secret', workers=4)
+    assert df.iloc[0]['DATA_COL'].split('|') == ['1000', ' ', '10', '200', '30', ' ', 'NaN', 'NaN', ' ',
+                                                 'Manufacturing', '1500', '2', '80',
+                                                 'Wholesale', '900', '5', '50', 'NaN', 'NaN', 'NaN', 'NaN']
+    assert (df['Year'] == 2019).all()
+    # 4 census requests per county, once per county
+    assert len([r for r in stub_http.requests if r.startswith('/data/')]) == 8
+
+@pytest.mark.skipif('NOAA_TEST_DSN' not in os.environ,
+                    reason='set NOAA_TEST_DSN to the connection string of a local postgres database')
+def test_ingest_local_database(stub_http, tmp_path, zone_county_csv):
+    import psycopg2
+    noaa_site(stub_http, {2019: '20220425', 2020: '20220425'})
+    conn = psycopg2.connect(os.environ['NOAA_TEST_DSN'])
+    try:
+        with conn, conn.cursor() as cur:
+            cur.execute('DROP TABLE IF EXISTS counties, noaa_versions')
+        kwargs = dict(work_dir=str(tmp_path), noaa_url=stub_http.url + '/noaa/',
+                      census_url=stub_http.url + '/data/', zone_county_csv=zone_county_csv)
+        storm_ingest.ingest(conn, [2019, 2020], **kwargs)
+        storm_ingest.ingest(conn, [2019, 2020], **kwargs) # resumes: both years are done
+        with conn, conn.cursor() as cur:
+            cur.execute('SELECT "Year", COUNT(*) FROM counties GROUP BY "Year" ORDER BY "Year"')
+            assert cur.fetchall() == [(2019, 3), (2020, 3)]
+        assert storm_ingest.get_loaded_versions(conn) == {2019: '20220425', 2020: '20220425'}
+    finally:
+        conn.close()
+
+def test_refresh_only_changed_years(stub_http, tmp_path, zone_county_csv, monkeypatch):
+    # the database is a dict year: version; 2020 was revised by NOAA since it was loaded
+    loaded = {2019: '20220101', 2020: '20220101'}
+    rows = {}
+    def load_year(conn, df_counties, year, fname):
+        rows[year] = df_counties.shape[0]
+        loaded[year] = storm_ingest.get_file_version(fname)
+    monkeypatch.setattr(storm_ingest, 'create_table', lambda conn: None)
+    monkeypatch.setattr(storm_ingest, 'get_loaded_versions', lambda conn: dict(loaded))
+    monkeypatch.setattr(storm_ingest, 'load_year', load_year)
+
+    fnames = noaa_site(stub_http, {2019: '20220101', 2020: '20220425'})
+    invalidated = []
+    storm_ingest.ingest(None, [2019, 2020], work_dir=str(tmp_path), noaa_url=stub_http.url + '/noaa/',
+                        census_url=stub_http.url + '/data/', zone_county_csv=zone_county_csv,
+                        refresh=True, on_year_loaded=invalidated.append)
+    assert rows == {2020: 3}
+    assert invalidated == [2020]
+    assert loaded == {2019: '20220101', 2020: '20220425'}
+    assert '/noaa/' + fnames[2019] not in stub_http.requests
+
+    invalidated.clear() # nothing changed since the last refresh
+    storm_ingest.ingest(None, [2019, 2020], work_dir=str(tmp_path), noaa_url=stub_http.url + '/noaa/',
+                        census_url=stub_http.url + '/data/', zone_county_csv=zone_county_csv,
+                        refresh=True, on_year_loaded=invalidated.append)
+    assert invalidated == []
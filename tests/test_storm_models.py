@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('sklearn')
+from notebooks.storm_models import build_analysis_df
+
+DATA_COL = '1000| |10|200|30| |5|90| |Manufacturing|1500|2|80|Retail|900|5|50|Wholesale|400|3|20'
+
+def counties(event_dates):
+    n = len(event_dates)
+    return pd.DataFrame({'TOTAL_DAMAGE': [2_000_000.0]*n, 'EVENT_DATE': pd.to_datetime(event_dates),
+                         'EVENT_TYPE': ['Flood']*n, 'DURATION': [3_600_000_000_000]*n, 'DATA_COL': [DATA_COL]*n,
+                         'TORNADO_STRENGTH': ['']*n, 'Tropical Cyclones/Floods': [True]*n,
+                         'Severe Local Storms': [False]*n, 'Wildfires/Droughts': [False]*n})
+
+# CPI up to 2021-08, like data/bls_cpi.csv
+df_bls_cpi = pd.DataFrame([(y, m, 100.0 + (y - 2019)*12 + m) for y in [2019, 2020, 2021] for m in range(1, 13)
+                           if (y, m) <= (2021, 8)], columns=['year', 'period', 'value'])
+
+def test_inflation_adjusted_damage():
+    df = build_analysis_df(counties(['2019-03-10', '2021-08-01']), df_bls_cpi)
+    expected = np.log(2_000_000.0*np.array([115.0/103.0, 120.0/132.0]))
+    np.testing.assert_allclose(df['TOTAL_DAMAGE'].values, expected)
+
+def test_missing_cpi_fails():
+    with pytest.raises(ValueError, match='2021-09'):
+        build_analysis_df(counties(['2019-03-10', '2021-09-01']), df_bls_cpi)
+
+def test_missing_cpi_dropped():
+    df = build_analysis_df(counties(['2019-03-10', '2021-09-01', '2021-10-05']), df_bls_cpi, missing_cpi='drop')
+    assert df.shape[0] == 1
+    np.testing.assert_allclose(df['TOTAL_DAMAGE'].values, [np.log(2_000_000.0*115.0/103.0)])
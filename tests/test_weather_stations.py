@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+
+from notebooks.weather_stations import StationIndex, haversine, closestn
+
+# synthetic station set: 500 random stations over the contiguous US
+rng = np.random.default_rng(591)
+df_stations = pd.DataFrame({'id': [f'US{i:09d}' for i in range(500)],
+                            'latitude': rng.uniform(25, 49, 500),
+                            'longitude': rng.uniform(-124, -67, 500)})
+df_points = pd.DataFrame({'LAT': rng.uniform(25, 49, 40),
+                          'LON': rng.uniform(-124, -67, 40)},
+                         index=np.arange(100, 140))
+
+def brute_force(lat, lon, k):
+    # full haversine scan over every station for every point
+    d = haversine(lat[:, None], lon[:, None],
+                  df_stations['latitude'].values, df_stations['longitude'].values)
+    idx = np.argsort(d, axis=1)[:, :k]
+    return np.take_along_axis(d, idx, axis=1), idx
+
+def test_query_matches_brute_force():
+    index = StationIndex(df_stations)
+    lat, lon = df_points['LAT'].values, df_points['LON'].values
+    for k, chunk_size in [(1, 1024), (5, 1024), (5, 7), (3, 1)]: # chunks smaller than the points
+        dist, idx = index.query(lat, lon, k=k, chunk_size=chunk_size)
+        dist_bf, idx_bf = brute_force(lat, lon, k)
+        assert dist.shape == (len(df_points), k)
+        np.testing.assert_allclose(dist, dist_bf)
+        np.testing.assert_array_equal(idx, idx_bf)
+
+def test_query_k_larger_than_stations():
+    index = StationIndex(df_stations.iloc[:4])
+    dist, idx = index.query(df_points['LAT'].values, df_points['LON'].values, k=10, chunk_size=16)
+    assert dist.shape == (len(df_points), 4) # every station, sorted by distance
+    assert (np.diff(dist, axis=1) >= 0).all()
+    np.testing.assert_array_equal(np.sort(idx, axis=1), np.tile(np.arange(4), (len(df_points), 1)))
+
+def test_nearest_rows_per_point():
+    df = StationIndex(df_stations).nearest(df_points, k=3)
+    assert df.shape[0] == 3*len(df_points)
+    assert df.index.tolist() == np.repeat(df_points.index.values, 3).tolist()
+    assert df['rank'].tolist() == [0, 1, 2]*len(df_points)
+    _, idx_bf = brute_force(df_points['LAT'].values, df_points['LON'].values, 3)
+    assert df['id'].tolist() == df_stations['id'].values[idx_bf.ravel()].tolist()
+
+def test_closestn_single_county():
+    county = df_points.iloc[0]
+    df = closestn(df_stations, county, n=3)
+    _, idx_bf = brute_force(df_points['LAT'].values[:1], df_points['LON'].values[:1], 3)
+    assert df['id'].tolist() == df_stations['id'].values[idx_bf[0]].tolist()
+    assert df['hav'].is_monotonic_increasing